@@ -1,22 +1,42 @@
+import argparse
+
 import dash
 
 
 from dash import dash_table
 from dash import dcc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dash import html
 from datetime import datetime as dt
 import plotly
 import plotly.graph_objs as go
 import sensor_data_mqtt_reader
+import sensor_capture
+import sensor_metrics
+import sensor_event_stream
+import sensor_shared_memory
+from dash_incremental_updates import incremental_window, extend_data, nothing_new, render_key, pushed
+from render_cache import RenderCache
+import downsampling
 
 app = dash.Dash(__name__, title="Live Sensor Updates")
-sensor_data_reader = sensor_data_mqtt_reader.SensorDataReader(queue_len=50)
+# Under several workers set SENSE_HAT_SHARED_MEMORY so they all read one ingest process
+sensor_data_reader = sensor_shared_memory.reader_from_environment(queue_len=50)
+# Prometheus text at /metrics: ingest counters from the reader plus callback timings
+sensor_metrics.instrument_dash(app, sensor_data_reader.metrics)
+# New gyro samples are pushed to the browser over Server-Sent Events, polling remains the fallback.
+# Each open page holds a worker thread for its stream, so run threaded or async workers, not gunicorn sync ones
+sensor_event_stream.install_event_stream(app, sensor_data_reader)
+# Bump when a figure layout changes so open clients fetch the full figure again
+GRAPH_LAYOUT_VERSION = 1
+render_cache = RenderCache()
+GYRO_INTERVAL_MS = 1 * 1000
 
 
 app.layout = html.Div(
     html.Div([
         html.H4('Plotted Sensor Data'),
+        dcc.Dropdown(id='device-select', value=sensor_data_mqtt_reader.DEFAULT_DEVICE, clearable=False),
         html.Div(id='live-update-text'),
         html.H5('Orientation Data'),
 
@@ -25,62 +45,189 @@ app.layout = html.Div(
         dcc.Graph(id='live-gyro-roll-graph', animate=False),
         dcc.Graph(id='live-gyro-pitch-graph', animate=False),
         dcc.Graph(id='live-gyro-graph', animate=False),
+        dcc.Store(id='gyro-graphs-state'),
+        dcc.Store(id='graph-width'),
+        dcc.Store(id='gyro-polar-graph-state'),
+        dcc.Store(id='gyro-graphs-stream'),
+        dcc.Store(id='gyro-polar-graph-stream'),
+        html.H5('Compare Devices'),
+        dcc.Dropdown(id='compare-devices', multi=True, value=[]),
+        dcc.RadioItems(id='compare-field', options=['yaw', 'roll', 'pitch'], value='yaw', inline=True),
+        dcc.Graph(id='device-compare-graph', animate=False),
+        dcc.Store(id='device-compare-state'),
         dcc.Interval(
             id='interval-component',
             interval=1 * 1000,  # in milliseconds
             n_intervals=0
+        ),
+        # Drives the pushed gyro graphs only, the push subscriber slows it down while the stream is open
+        dcc.Interval(
+            id='gyro-interval-component',
+            interval=GYRO_INTERVAL_MS,
+            n_intervals=0
         )
     ])
 )
+# Graph width in pixels as seen by the browser, sets how many points a full figure is downsampled to
+app.clientside_callback(
+    "function(n) { return window.innerWidth; }",
+    Output('graph-width', 'data'),
+    Input('interval-component', 'n_intervals')
+)
+app.clientside_callback(
+    sensor_event_stream.stream_subscriber('live-gyro-yaw-graph', 'gyro-graphs-state', 'gyro',
+                                          {'x': ['ts', 'ts', 'ts'], 'y': ['yaw', 'roll', 'pitch']},
+                                          sensor_data_reader.queue_len, interval_id='gyro-interval-component',
+                                          interval_ms=GYRO_INTERVAL_MS),
+    Output('gyro-graphs-stream', 'data'),
+    Input('gyro-graphs-state', 'data'),
+    State('device-select', 'value')
+)
+app.clientside_callback(
+    sensor_event_stream.stream_subscriber('live-gyro-graph', 'gyro-polar-graph-state', 'gyro',
+                                          {'r': ['pitch'], 'theta': ['roll']}, sensor_data_reader.queue_len),
+    Output('gyro-polar-graph-stream', 'data'),
+    Input('gyro-polar-graph-state', 'data'),
+    State('device-select', 'value')
+)
+
+
+@app.callback([Output('device-select', 'options'),
+               Output('compare-devices', 'options')],
+              Input('interval-component', 'n_intervals'))
+def update_device_options(n):
+    options = sensor_data_reader.device_ids()
+    return [options, options]
+
+
+def graph_layout_version(device_id):
+    # Switching device changes what the graphs show, so it counts as a layout change
+    return "%d:%s" % (GRAPH_LAYOUT_VERSION, device_id)
+
+
+def downsample_settings(buffer, width):
+    max_points = downsampling.target_points(width)
+    if len(buffer) <= max_points:
+        return max_points, None
+    # Raw samples appended after a downsampled figure trigger a new full figure once they add up
+    return max_points, max(1, max_points // 10)
+
+
 @app.callback([
     Output('live-gyro-yaw-graph','figure'),
+    Output('live-gyro-yaw-graph','extendData'),
     Output('live-gyro-roll-graph','figure'),
     Output('live-gyro-pitch-graph','figure'),
+    Output('gyro-graphs-state','data'),
                ],
-    Input('interval-component', 'n_intervals')
+    Input('gyro-interval-component', 'n_intervals'),
+    Input('device-select', 'value'),
+    State('gyro-graphs-state', 'data'),
+    State('graph-width', 'data')
 )
-def update_gyro_graphs(n):
-    yaw = go.Scatter(
-        y=[point["yaw"] for point in sensor_data_reader.gyro_data_q],
-        x=[point["ts"] for point in sensor_data_reader.gyro_data_q],
-        name='Scatter',
-        mode='lines+markers'
-    )
+def update_gyro_graphs(n, device_id, client_state, width):
+    buffer = sensor_data_reader.device(device_id).gyro_data_q
+    max_points, refresh_after = downsample_settings(buffer, width)
+    full_refresh, gyro, new_state = incremental_window(buffer, client_state, graph_layout_version(device_id),
+                                                       refresh_after)
+    if not full_refresh and (nothing_new(gyro) or pushed(client_state)):
+        return [dash.no_update] * 5
+    key = render_key('gyro-graphs', full_refresh, client_state, new_state, max_points)
+    if full_refresh:
+        return [render_cache.get_or_render(key, lambda: render_gyro_figure(gyro, max_points)),
+                dash.no_update, None, None, new_state]
+    return [dash.no_update,
+            render_cache.get_or_render(key, lambda: render_gyro_points(gyro, buffer.capacity)),
+            dash.no_update, dash.no_update, new_state]
+
+
+def render_gyro_points(gyro, max_points):
+    ts = sensor_data_reader.to_datetimes(gyro["ts"])
+    return extend_data(dict(x=[ts, ts, ts], y=[gyro["yaw"], gyro["roll"], gyro["pitch"]]), max_points)
+
+
+def render_gyro_figure(gyro, max_points):
+    yaw = downsampling.downsample(gyro, "yaw", max_points)
+    roll = downsampling.downsample(gyro, "roll", max_points)
+    pitch = downsampling.downsample(gyro, "pitch", max_points)
     figure = go.Figure(layout={'uirevision': 'button'})
     figure.add_trace(go.Scatter(
-        y=[point["yaw"] for point in sensor_data_reader.gyro_data_q],
-        x=[point["ts"] for point in sensor_data_reader.gyro_data_q],
+        y=yaw["yaw"],
+        x=sensor_data_reader.to_datetimes(yaw["ts"]),
         name='Yaw',
-        mode='lines+markers'
+        mode='lines+markers',
+        line_shape='hv'
     ))
     figure.add_trace(go.Scatter(
-        y=[point["roll"] for point in sensor_data_reader.gyro_data_q],
-        x=[point["ts"] for point in sensor_data_reader.gyro_data_q],
+        y=roll["roll"],
+        x=sensor_data_reader.to_datetimes(roll["ts"]),
         name='Roll',
-        mode='lines+markers'
+        mode='lines+markers',
+        line_shape='hv'
     ))
     figure.add_trace(go.Scatter(
-        y=[point["pitch"] for point in sensor_data_reader.gyro_data_q],
-        x=[point["ts"] for point in sensor_data_reader.gyro_data_q],
+        y=pitch["pitch"],
+        x=sensor_data_reader.to_datetimes(pitch["ts"]),
         name='Pitch',
-        mode='lines+markers'
+        mode='lines+markers',
+        line_shape='hv'
     ))
     figure.update_layout(title="Gyro"
                          )
     figure.update_yaxes(range=[0, 370])
-    return [figure, None,None]
+    return figure.to_plotly_json()
 
 @app.callback([
                 Output('live-gyro-graph', 'figure'),
-                Output('live-update-text', 'children')
+                Output('live-gyro-graph', 'extendData'),
+                Output('gyro-polar-graph-state', 'data')
                 ],
-              Input('interval-component', 'n_intervals'))
-def update_sensor_simple_data(n):
+              Input('gyro-interval-component', 'n_intervals'),
+              Input('device-select', 'value'),
+              State('gyro-polar-graph-state', 'data'),
+              State('graph-width', 'data'))
+def update_sensor_simple_data(n, device_id, client_state, width):
+    buffer = sensor_data_reader.device(device_id).gyro_data_q
+    max_points, refresh_after = downsample_settings(buffer, width)
+    full_refresh, gyro, new_state = incremental_window(buffer, client_state, graph_layout_version(device_id),
+                                                       refresh_after)
+    if not full_refresh and (nothing_new(gyro) or pushed(client_state)):
+        return [dash.no_update] * 3
+
+    key = render_key('gyro-polar-graph', full_refresh, client_state, new_state, max_points)
+    figure = dash.no_update
+    new_points = dash.no_update
+    if full_refresh:
+        figure = render_cache.get_or_render(key, lambda: render_gyro_polar_figure(gyro, max_points))
+    else:
+        new_points = render_cache.get_or_render(
+            key, lambda: extend_data(dict(r=[gyro["pitch"]], theta=[gyro["roll"]]), buffer.capacity))
+    return [figure, new_points, new_state]
+
+
+@app.callback(Output('live-update-text', 'children'),
+              Input('interval-component', 'n_intervals'),
+              Input('device-select', 'value'))
+def update_live_text(n, device_id):
+    # Polled on its own, the readout keeps updating while the graphs receive pushed samples
+    latest_data = sensor_data_reader.device(device_id).gyro_data_q.latest()
+    style = {'padding': '5px', 'fontSize': '14px'}
+    if latest_data is None:
+        return [html.Span("Waiting for gyro data", style=style)]
+    return [
+        html.Span("Pitch : {:.2f} Yaw : {:.2f} Roll {:.3f}".format(
+            latest_data["pitch"], latest_data["yaw"], latest_data["roll"]),
+                  style=style),
+    ]
+
+
+def render_gyro_polar_figure(gyro, max_points):
+    gyro = downsampling.downsample(gyro, "pitch", max_points)
     roll = go.Scatterpolar(
-        r=[point["pitch"] for point in sensor_data_reader.gyro_data_q],
-        theta=[point["roll"] for point in sensor_data_reader.gyro_data_q],
+        r=gyro["pitch"],
+        theta=gyro["roll"],
         mode='markers',
-        #marker = dict(size=[point["yaw"] for point in sensor_data_reader.gyro_data_q],)
+        #marker = dict(size=gyro["yaw"],)
     )
     figure = go.Figure(data=roll, layout={'uirevision': 'button'})
     figure.update_layout(
@@ -90,16 +237,56 @@ def update_sensor_simple_data(n):
         ),
         width=500, height=500
     )
-    latest_data = sensor_data_reader.gyro_data_q[-1]
-    style = {'padding': '5px', 'fontSize': '14px'}
-    return [figure,
-            [
-                html.Span("Pitch : {:.2f} Yaw : {:.2f} Roll {:.3f}".format(
-                    latest_data["pitch"], latest_data["yaw"], latest_data["roll"]),
-                          style=style),
-            ]
-            ]
+    return figure.to_plotly_json()
+
+
+@app.callback([Output('device-compare-graph', 'figure'),
+               Output('device-compare-state', 'data')],
+              Input('interval-component', 'n_intervals'),
+              Input('compare-devices', 'value'),
+              Input('compare-field', 'value'),
+              State('device-compare-state', 'data'),
+              State('graph-width', 'data'))
+def update_device_compare_graph(n, device_ids, field, client_state, width):
+    device_ids = sorted(device_ids or [])
+    versions = [sensor_data_reader.version("gyro", device_id) for device_id in device_ids]
+    state = {"devices": device_ids, "field": field, "versions": versions}
+    if state == client_state:
+        return [dash.no_update] * 2
+    max_points = downsampling.target_points(width)
+    key = ('device-compare', tuple(device_ids), field, tuple(versions), max_points)
+    figure = render_cache.get_or_render(key, lambda: render_device_compare_figure(device_ids, field, max_points))
+    return [figure, state]
+
+
+def render_device_compare_figure(device_ids, field, max_points):
+    figure = go.Figure(layout={'uirevision': 'button'})
+    columns = {device_id: sensor_data_reader.snapshot("gyro", device_id).columns() for device_id in device_ids}
+    # Devices publishing with a deadband go quiet while unchanged, draw them flat up to the newest sample
+    latest_ts = max([gyro["ts"][-1] for gyro in columns.values() if len(gyro["ts"])], default=0)
+    for device_id in device_ids:
+        gyro = downsampling.downsample(columns[device_id], field, max_points)
+        gyro = sensor_data_reader.hold_last_value(gyro, latest_ts)
+        figure.add_trace(go.Scatter(
+            y=gyro[field],
+            x=sensor_data_reader.to_datetimes(gyro["ts"]),
+            name=device_id,
+            mode='lines',
+            line_shape='hv'
+        ))
+    figure.update_layout(title="Gyro " + field.capitalize() + " by device")
+    figure.update_yaxes(range=[0, 370])
+    return figure.to_plotly_json()
 
 if __name__ == '__main__':
-    sensor_data_reader.init_and_start_mqtt()
-    app.run_server(debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Dash app showing live Sense Hat data")
+    sensor_capture.add_arguments(parser)
+    args = parser.parse_args()
+    if isinstance(sensor_data_reader, sensor_shared_memory.SharedSensorDataReader):
+        print("Reading sensor data shared by the ingest process")
+    else:
+        sensor_capture.start_reader(sensor_data_reader, args)
+    try:
+        app.run_server(debug=True)
+    finally:
+        sensor_data_reader.close()
\ No newline at end of file
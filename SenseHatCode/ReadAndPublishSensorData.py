@@ -1,22 +1,38 @@
-from sense_hat import SenseHat
+try:
+    from sense_hat import SenseHat
+except ImportError:
+    # Only needed on the Pi, --simulate runs without it
+    SenseHat = None
 import json
-from datetime import datetime as dt
-import time
 import argparse
 import paho.mqtt.client as mqtt
 import logging as l
 import traceback
+import threading
+import sensor_payload_codec
+from publish_spool import PublishSpool
+from deadband_filter import DeadbandFilter, parse_deadbands, DEFAULT_HEARTBEAT_SECS
+from sense_hat_simulator import SimulatedSenseHat
+from imu_window_aggregator import STATS_SUFFIX
+from publish_pipeline import PublishPipeline, JSON_ENCODING, BINARY_ENCODING, DEFAULT_MAX_INFLIGHT, \
+    DEFAULT_QOS, DEFAULT_SAMPLE_QUEUE_LEN, DEFAULT_SPOOL_DRAIN_RATE
 
 DEFAULT_MQTT_SERVER = "pi-fw.local"
 READ_FREQUENCY_SEC = 0
+STATS_INTERVAL_SEC = 60
 
-SENSOR_TOPIC_BASE = "sense_hat/data"
+SPOOL_MAX_MB = 64
+
+SENSOR_TOPIC_ROOT = "sense_hat"
+SENSOR_TOPIC_BASE = SENSOR_TOPIC_ROOT + "/data"
 SENSOR_TOPIC_BASIC_DATA = SENSOR_TOPIC_BASE + "/basic"
 ACC_TOPIC = SENSOR_TOPIC_BASE + "/accel"
 ACC_RAW_TOPIC = SENSOR_TOPIC_BASE + "/accel_raw"
 GYRO_TOPIC = SENSOR_TOPIC_BASE + "/gyro"
 GYRO_RAW_TOPIC = SENSOR_TOPIC_BASE + "/gyro_raw"
 ORIENTATION_TOPIC = SENSOR_TOPIC_BASE + "/orientation"
+ACC_RAW_STATS_TOPIC = ACC_RAW_TOPIC + STATS_SUFFIX
+GYRO_RAW_STATS_TOPIC = GYRO_RAW_TOPIC + STATS_SUFFIX
 
 SENSOR_BASIC = 'basic_sensor'
 ACCEL = 'accel'
@@ -24,8 +40,25 @@ ACCEL_RAW = 'accel_raw'
 GYRO = 'gyro'
 GYRO_RAW = 'gyro_raw'
 ORIENTATION = 'orientation'
+ACCEL_RAW_STATS = ACCEL_RAW + STATS_SUFFIX
+GYRO_RAW_STATS = GYRO_RAW + STATS_SUFFIX
 
 list_of_sensors = {SENSOR_BASIC, ACCEL, ACCEL_RAW, GYRO, GYRO_RAW, ORIENTATION}
+# High rate sensors that can be sent as multi sample frames
+BATCHABLE_SENSORS = {ACCEL, GYRO, ORIENTATION}
+# Raw IMU streams that can be published as per window statistics instead of every sample
+AGGREGATABLE_SENSORS = [ACCEL_RAW, GYRO_RAW]
+mqtt_connected = threading.Event()
+
+# Default read rate per sensor in Hz, the IMU is fast while humidity/pressure change slowly
+DEFAULT_SENSOR_RATES_HZ = {
+    SENSOR_BASIC: 0.2,
+    ACCEL: 100,
+    ACCEL_RAW: 100,
+    GYRO: 100,
+    GYRO_RAW: 100,
+    ORIENTATION: 100
+}
 
 
 def read_basic_sensor_data(sense):
@@ -71,11 +104,29 @@ sensor_function_map = {
     GYRO_RAW: (read_gyro_raw, GYRO_RAW_TOPIC),
     ORIENTATION: (read_orientation, ORIENTATION_TOPIC)
 }
-
-
-def setup_sensehat():
-    l.info("Setting up Sense Hat")
-    sense = SenseHat()
+sensor_topics = {sensor: topic for sensor, (_, topic) in sensor_function_map.items()}
+sensor_topics.update({ACCEL_RAW_STATS: ACC_RAW_STATS_TOPIC, GYRO_RAW_STATS: GYRO_RAW_STATS_TOPIC})
+topic_to_sensor = {topic: sensor for sensor, topic in sensor_topics.items()}
+
+
+def device_topic(topic, device_id):
+    # sense_hat/data/<sensor> becomes sense_hat/<device id>/data/<sensor>
+    if not device_id:
+        return topic
+    if not sensor_payload_codec.valid_device_id(device_id):
+        raise argparse.ArgumentTypeError("Device id can not be '.' or '..' or contain '/', '+' or '#': " + device_id)
+    return SENSOR_TOPIC_ROOT + "/" + device_id + topic[len(SENSOR_TOPIC_ROOT):]
+
+
+def setup_sensehat(simulate=False):
+    if simulate:
+        l.info("Setting up simulated Sense Hat")
+        sense = SimulatedSenseHat()
+    elif SenseHat is None:
+        raise RuntimeError("The sense_hat package is not installed, use --simulate to run without a Sense Hat")
+    else:
+        l.info("Setting up Sense Hat")
+        sense = SenseHat()
     sense.set_imu_config(True, True, True)
     return sense
 
@@ -83,23 +134,79 @@ def setup_sensehat():
 def setup_mqtt(server):
     # MQTT call backs
     def on_connect(client, userdata, flags, rc):
-        l.info("MQTT Connected")
+        if rc == 0:
+            l.info("MQTT Connected")
+            mqtt_connected.set()
+        else:
+            l.error("MQTT Connection refused, rc %d" % rc)
 
     def on_disconnect(client, userdata, rc):
         l.info("MQTT Disconnected")
+        mqtt_connected.clear()
 
     l.info("Setting up Connection to MQTT server %s " % server)
     mqtt_client = mqtt.Client()
     mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_connect = on_connect
-    mqtt_client.connect(server)
+    # Connect and reconnect in paho's network thread so sampling never waits on the broker
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
+    mqtt_client.connect_async(server)
+    mqtt_client.loop_start()
     return mqtt_client
 
 
-def publish_data(topic, data):
-    # l.info("Publishing data to " + topic)
-    data["ts"] = dt.now().timestamp()
-    mqtt_client.publish(topic, json.dumps(data), retain=True)
+def setup_spool(spool_dir, spool_max_mb):
+    if not spool_dir:
+        return None
+    l.info("Spooling up to %d MB to %s while the MQTT server is unreachable" % (spool_max_mb, spool_dir))
+    return PublishSpool(spool_dir, max_bytes=int(spool_max_mb * 1024 * 1024))
+
+
+def parse_sensor_rates(rate_args):
+    rates = {}
+    for rate_arg in rate_args:
+        sensor, _, rate = rate_arg.partition("=")
+        if sensor not in list_of_sensors or not rate:
+            raise argparse.ArgumentTypeError("Invalid sensor rate " + rate_arg + ", expected <sensor>=<hz>")
+        rates[sensor] = float(rate)
+    return rates
+
+
+def setup_deadband(deadband_args, heartbeat_secs):
+    if not deadband_args:
+        return None
+    sensor_fields = {sensor: fields for sensor, fields in sensor_payload_codec.SENSOR_SCHEMAS.values()}
+    thresholds = parse_deadbands(deadband_args, sensor_fields)
+    l.info("Publishing only changes beyond %s, heartbeat every %.1f sec" % (str(thresholds), heartbeat_secs))
+    return DeadbandFilter(thresholds, heartbeat_secs)
+
+
+def build_pipeline(sense, mqtt_client, sensors, rates, args, deadband=None, spool=None):
+    if args.batch_size > 0 or args.batch_ms > 0:
+        l.info("Batching %s in frames of up to %d samples / %d ms" % (str(BATCHABLE_SENSORS), args.batch_size,
+                                                                       args.batch_ms))
+    aggregated = set(args.aggregate_sensors).intersection(sensors) if args.aggregate_window > 0 else set()
+    if aggregated:
+        l.info("Publishing %s as statistics over windows of %d samples" % (str(aggregated), args.aggregate_window))
+    topics = {s: sensor_topics[s] for s in sensors}
+    topics.update({s + STATS_SUFFIX: sensor_topics[s + STATS_SUFFIX] for s in aggregated})
+    return PublishPipeline(sense, mqtt_client, mqtt_connected,
+                           {s: sensor_function_map[s][0] for s in sensors},
+                           topics,
+                           {s: rates[s] for s in sensors},
+                           encoding=args.encoding,
+                           batch_size=args.batch_size,
+                           batch_ms=args.batch_ms,
+                           batchable_sensors=BATCHABLE_SENSORS,
+                           deadband=deadband,
+                           spool=spool,
+                           spool_drain_rate=args.spool_drain_rate,
+                           qos=args.qos,
+                           max_inflight=args.max_inflight,
+                           queue_len=args.sample_queue_len,
+                           stats_interval_secs=args.stats_interval_secs,
+                           aggregate_window=args.aggregate_window,
+                           aggregated_sensors=aggregated)
 
 
 def log_sensor_readings(humidity, temp, temp_from_pressure, pressure, north, compass_raw,
@@ -139,8 +246,46 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Optionally specify the MQTT server and update frequency")
     parser.add_argument("-m", "--mqtt_server", help="MQTT Server location", default=DEFAULT_MQTT_SERVER)
-    parser.add_argument("-f", "--update_freq_secs", type=int, help="Update frequency in Seconds",
+    parser.add_argument("-f", "--update_freq_secs", type=float,
+                        help="Update period in seconds for every sensor without an explicit rate",
                         default=READ_FREQUENCY_SEC)
+    parser.add_argument("-r", "--sensor_rates", nargs='+', type=str, default=[],
+                        help="Per sensor read rate in Hz as <sensor>=<hz>, e.g. accel=100 basic_sensor=0.2. "
+                             "Defaults " + str(DEFAULT_SENSOR_RATES_HZ))
+    parser.add_argument("--stats_interval_secs", type=float, default=STATS_INTERVAL_SEC,
+                        help="How often to log per sensor run and overrun counts, 0 to disable")
+    parser.add_argument("-b", "--batch_size", type=int, default=0,
+                        help="Send accel/gyro/orientation as frames of this many samples, 0 to disable")
+    parser.add_argument("--batch_ms", type=int, default=0,
+                        help="Send a frame once its oldest sample is this many milliseconds old, 0 to disable")
+    parser.add_argument("-e", "--encoding", choices=[JSON_ENCODING, BINARY_ENCODING], default=JSON_ENCODING,
+                        help="Payload encoding, binary is a compact fixed layout understood by SensorDataReader")
+    parser.add_argument("--deadband", nargs='+', type=str, default=[],
+                        help="Only publish a reading when a field moved more than a threshold since the last published "
+                             "one, as <sensor>.<field>=<threshold> or <sensor>=<threshold> for all its fields")
+    parser.add_argument("--heartbeat_secs", type=float, default=DEFAULT_HEARTBEAT_SECS,
+                        help="Publish deadband filtered sensors at least this often")
+    parser.add_argument("--spool_dir", default=None,
+                        help="Directory to keep samples in while the MQTT server is unreachable, disabled if not set")
+    parser.add_argument("--spool_max_mb", type=float, default=SPOOL_MAX_MB,
+                        help="Spool size cap in MB, the oldest samples are dropped beyond it")
+    parser.add_argument("--spool_drain_rate", type=float, default=DEFAULT_SPOOL_DRAIN_RATE,
+                        help="Messages per second replayed from the spool once reconnected")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=DEFAULT_QOS, help="MQTT QoS for sensor data")
+    parser.add_argument("--max_inflight", type=int, default=DEFAULT_MAX_INFLIGHT,
+                        help="Messages handed to the MQTT client but not yet sent (QoS 0) or acknowledged (QoS 1/2) "
+                             "before publishing waits")
+    parser.add_argument("--sample_queue_len", type=int, default=DEFAULT_SAMPLE_QUEUE_LEN,
+                        help="Samples held between the sampling and publishing threads, the oldest is dropped beyond it")
+    parser.add_argument("-d", "--device_id", default=None,
+                        help="Publish under sense_hat/<device_id>/data/... so one subscriber can tell Sense HATs apart")
+    parser.add_argument("--aggregate_window", type=int, default=0,
+                        help="Publish the raw IMU as mean/var/min/max/rms/p2p over windows of this many samples "
+                             "on <topic>_stats instead of every sample, 0 to disable")
+    parser.add_argument("--aggregate_sensors", nargs='+', choices=AGGREGATABLE_SENSORS, default=AGGREGATABLE_SENSORS,
+                        help="Sensors to aggregate with --aggregate_window")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Read from a simulated Sense Hat, for development and benchmarks without a Pi")
     parser.add_argument("-s", "--sensors_to_read", nargs='+', type=str,
                         help="List of Sensors to read " + str(list_of_sensors),
                         default=list_of_sensors)
@@ -149,26 +294,46 @@ if __name__ == '__main__':
     invalid_sensors_provided = set(args.sensors_to_read).difference(list_of_sensors)
     if bool(invalid_sensors_provided):
         l.error("Ignoring Invalid Sensors " + str(invalid_sensors_provided))
-
-    l.info("Reading sensors " + str(list_of_sensors))
-    sense = setup_sensehat()
+    sensors_to_read = list_of_sensors.intersection(args.sensors_to_read)
+    if not bool(sensors_to_read):
+        l.error("No valid sensors provided " + str(args.sensors_to_read))
+        exit(1)
+
+    sensor_rates = dict(DEFAULT_SENSOR_RATES_HZ)
+    if args.update_freq_secs > 0:
+        sensor_rates = {s: 1.0 / args.update_freq_secs for s in list_of_sensors}
+    try:
+        sensor_rates.update(parse_sensor_rates(args.sensor_rates))
+        sensor_topics = {s: device_topic(topic, args.device_id) for s, topic in sensor_topics.items()}
+        topic_to_sensor = {topic: s for s, topic in sensor_topics.items()}
+        deadband = setup_deadband(args.deadband, args.heartbeat_secs)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+
+    l.info("Reading sensors " + str({s: sensor_rates[s] for s in sensors_to_read}) + " (Hz)")
+    try:
+        sense = setup_sensehat(args.simulate)
+    except RuntimeError as e:
+        parser.error(str(e))
+    spool = setup_spool(args.spool_dir, args.spool_max_mb)
+    pipeline = None
     try:
         mqtt_client = setup_mqtt(args.mqtt_server)
-        l.info("Starting the loop every %d sec to capture and publish sensor data " % args.update_freq_secs)
-        while (True):  # Main loop
-            for s in list_of_sensors:
-                sensor_function_and_topic = sensor_function_map.get(s)
-                readings = sensor_function_and_topic[0](sense)
-                publish_data(sensor_function_and_topic[1], readings)
-
-            time.sleep(args.update_freq_secs)
+        pipeline = build_pipeline(sense, mqtt_client, sensors_to_read, sensor_rates, args, deadband, spool)
+        l.info("Starting the sampling and publishing threads")
+        pipeline.start()
+        pipeline.wait()  # Main loop
+        if pipeline.failure is not None:
+            l.error("The %s thread failed, exiting" % pipeline.failure)
 
     except Exception as e:
         traceback.print_exc()
         l.error("Error connecting to MQTT Server " + args.mqtt_server + " exiting")
-
-    sensors_to_read = list_of_sensors.difference(args.sensors_to_read)
-    if bool(sensors_to_read):
-        None
-    else:
-        l.error("No valid sensors provided " + str(args.sensors_to_read))
\ No newline at end of file
+    finally:
+        if pipeline is not None:
+            pipeline.stop()
+            pipeline.log_stats()
+        if spool is not None:
+            spool.close()
+    if pipeline is not None and pipeline.failure is not None:
+        exit(1)
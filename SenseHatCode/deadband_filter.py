@@ -0,0 +1,63 @@
+import time
+
+DEFAULT_HEARTBEAT_SECS = 30
+# Fields in degrees, their change is measured the short way round the circle
+ANGLE_FIELDS = {"roll", "pitch", "yaw", "compass_north"}
+
+
+class DeadbandFilter:
+    """Decides whether a reading differs enough from the last published one to be sent.
+
+    thresholds maps sensor -> {field: threshold}. A reading is published when
+    any configured field moved by more than its threshold since the last
+    published reading of that sensor, or when heartbeat_secs passed since then
+    so subscribers can tell an unchanged value from a dead publisher. Sensors
+    without thresholds are always published.
+    """
+
+    def __init__(self, thresholds, heartbeat_secs=DEFAULT_HEARTBEAT_SECS, clock=time.monotonic):
+        self.thresholds = thresholds
+        self.heartbeat_secs = heartbeat_secs
+        self.clock = clock
+        self.last_published = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def should_publish(self, sensor, reading):
+        fields = self.thresholds.get(sensor)
+        if not fields:
+            return True
+        now = self.clock()
+        last = self.last_published.get(sensor)
+        if last is None or now - last[0] >= self.heartbeat_secs or self._changed(fields, last[1], reading):
+            self.last_published[sensor] = (now, {f: reading[f] for f in fields})
+            self.published += 1
+            return True
+        self.suppressed += 1
+        return False
+
+    @staticmethod
+    def _changed(fields, last, reading):
+        for field, threshold in fields.items():
+            delta = abs(reading[field] - last[field])
+            if field in ANGLE_FIELDS:
+                delta = min(delta % 360, 360 - delta % 360)
+            if delta > threshold:
+                return True
+        return False
+
+
+def parse_deadbands(deadband_args, sensor_fields):
+    """Parses ["<sensor>.<field>=<threshold>" | "<sensor>=<threshold>", ...] into DeadbandFilter thresholds.
+
+    sensor_fields maps every sensor to its field names, a bare sensor applies the threshold to all of them.
+    """
+    thresholds = {}
+    for deadband_arg in deadband_args:
+        target, _, threshold = deadband_arg.partition("=")
+        sensor, _, field = target.partition(".")
+        if sensor not in sensor_fields or (field and field not in sensor_fields[sensor]) or not threshold:
+            raise ValueError("Invalid deadband " + deadband_arg + ", expected <sensor>[.<field>]=<threshold>")
+        for f in ([field] if field else sensor_fields[sensor]):
+            thresholds.setdefault(sensor, {})[f] = float(threshold)
+    return thresholds
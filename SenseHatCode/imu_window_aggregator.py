@@ -0,0 +1,48 @@
+import numpy as np
+
+from sensor_payload_codec import IMU_WINDOW_STATS
+
+STATS_SUFFIX = "_stats"
+
+
+class WindowAggregator:
+    """Summarises fixed size, non overlapping windows of a raw IMU stream.
+
+    Samples are written into a preallocated (window_size, fields) array. Once
+    it is full, mean, variance, min, max, RMS and peak-to-peak are computed per
+    field in a few NumPy reductions and returned as one summary with the
+    ts of the window's last sample, then the window starts over.
+    """
+
+    def __init__(self, fields, window_size):
+        if window_size < 1:
+            raise ValueError("Window size must be at least 1, got %d" % window_size)
+        self.fields = tuple(fields)
+        self.window = np.empty((window_size, len(self.fields)))
+        self.filled = 0
+        self.windows = 0
+
+    def add(self, sample):
+        self.window[self.filled] = [sample[f] for f in self.fields]
+        self.filled += 1
+        if self.filled < len(self.window):
+            return None
+        self.filled = 0
+        self.windows += 1
+        summary = self.summarise(self.window)
+        summary["ts"] = sample["ts"]
+        return summary
+
+    def summarise(self, window):
+        mins = window.min(axis=0)
+        maxs = window.max(axis=0)
+        stats = {
+            "mean": window.mean(axis=0),
+            "var": window.var(axis=0),
+            "min": mins,
+            "max": maxs,
+            "rms": np.sqrt(np.einsum("ij,ij->j", window, window) / len(window)),
+            "p2p": maxs - mins
+        }
+        return {"%s_%s" % (field, stat): float(stats[stat][i])
+                for i, field in enumerate(self.fields) for stat in IMU_WINDOW_STATS}
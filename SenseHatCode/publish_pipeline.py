@@ -0,0 +1,270 @@
+import json
+import logging as l
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+import sensor_payload_codec
+from imu_window_aggregator import WindowAggregator, STATS_SUFFIX
+from sample_batcher import SampleBatcher
+from sensor_scheduler import SensorScheduler
+
+JSON_ENCODING = "json"
+BINARY_ENCODING = "binary"
+
+DEFAULT_SAMPLE_QUEUE_LEN = 10000
+DEFAULT_MAX_INFLIGHT = 100
+DEFAULT_QOS = 0
+DEFAULT_SPOOL_DRAIN_RATE = 200  # messages per second replayed from the spool after a reconnect
+INFLIGHT_WAIT_SECS = 1.0
+PUBLISH_IDLE_WAIT_SECS = 0.05
+
+
+class PublishPipeline:
+    """Sense HAT sampling and MQTT publishing on two separate threads.
+
+    The sampling thread runs a SensorScheduler that reads each sensor on its
+    own schedule, stamps the reading and appends it to a bounded deque (the
+    oldest sample is dropped and counted when it is full). The publishing
+    thread drains the deque and applies the deadband, batching, encoding and
+    in-flight limit before handing messages to paho, or to the spool when the
+    broker is unreachable. Slow network I/O therefore never delays a read.
+    With aggregate_window set, aggregated_sensors are not published sample by
+    sample but as one summary per window on their "<sensor>_stats" topic.
+
+    Errors publishing a sample are counted and the sample skipped. Should
+    either thread still die, the other is stopped too and failure names it,
+    so wait() returns instead of hanging.
+    """
+
+    def __init__(self, sense, mqtt_client, connected, sensor_functions, sensor_topics, sensor_rates,
+                 encoding=JSON_ENCODING, batch_size=0, batch_ms=0, batchable_sensors=(), deadband=None,
+                 spool=None, spool_drain_rate=DEFAULT_SPOOL_DRAIN_RATE, qos=DEFAULT_QOS,
+                 max_inflight=DEFAULT_MAX_INFLIGHT, queue_len=DEFAULT_SAMPLE_QUEUE_LEN, stats_interval_secs=0,
+                 aggregate_window=0, aggregated_sensors=()):
+        self.sense = sense
+        self.mqtt_client = mqtt_client
+        self.connected = connected
+        self.sensor_functions = sensor_functions
+        self.sensor_topics = sensor_topics
+        self.topic_to_sensor = {topic: sensor for sensor, topic in sensor_topics.items()}
+        self.encoding = encoding
+        self.deadband = deadband
+        self.spool = spool
+        self.spool_drain_rate = spool_drain_rate
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.stats_interval_secs = stats_interval_secs
+
+        self.scheduler = SensorScheduler()
+        for sensor, rate in sensor_rates.items():
+            self.scheduler.add_task(sensor, rate, lambda sensor=sensor: self.sample(sensor))
+        self.batcher = None
+        if batch_size > 0 or batch_ms > 0:
+            self.batcher = SampleBatcher({sensor_topics[s] for s in batchable_sensors if s in sensor_topics},
+                                         self.publish_frame, max_samples=batch_size, max_age_ms=batch_ms)
+        self.aggregators = {}
+        if aggregate_window > 0:
+            schemas = sensor_payload_codec.SENSOR_SCHEMAS
+            self.aggregators = {s: WindowAggregator(schemas[sensor_payload_codec.SENSOR_IDS[s]][1], aggregate_window)
+                                for s in aggregated_sensors if s in sensor_functions}
+
+        # deque append/popleft are atomic, so the sampling thread never waits on the publisher
+        self.samples = deque()
+        self.queue_len = queue_len
+        self.samples_ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+        # Re-entrant so an on_publish fired from within publish() on this thread can not deadlock
+        self.inflight_lock = threading.Condition(threading.RLock())
+        self.inflight = set()
+        mqtt_client.on_publish = self.on_publish
+        # Chained so the connection tracking the client was set up with keeps working
+        self.client_on_disconnect = mqtt_client.on_disconnect
+        mqtt_client.on_disconnect = self.on_disconnect
+
+        self.sampled = 0
+        self.dropped_samples = 0
+        self.max_queue_depth = 0
+        self.published = 0
+        self.spooled = 0
+        self.inflight_timeouts = 0
+        self.publish_errors = 0
+        self.lost_on_disconnect = 0
+        self.failure = None
+
+    def sample(self, sensor):
+        readings = self.sensor_functions[sensor](self.sense)
+        readings["ts"] = time.time()
+        if len(self.samples) >= self.queue_len:
+            self.samples.popleft()
+            self.dropped_samples += 1
+        self.samples.append((sensor, readings))
+        self.sampled += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self.samples))
+        self.samples_ready.set()
+
+    def encode_payload(self, topic, samples):
+        if self.encoding == BINARY_ENCODING:
+            return sensor_payload_codec.encode(self.topic_to_sensor[topic], samples)
+        if len(samples) == 1:
+            return json.dumps(samples[0])
+        # One message carrying several samples, each with its own "ts"
+        return json.dumps({"samples": samples})
+
+    def publish_data(self, sensor, readings):
+        aggregator = self.aggregators.get(sensor)
+        if aggregator is not None:
+            summary = aggregator.add(readings)
+            if summary is not None:
+                self.publish_data(sensor + STATS_SUFFIX, summary)
+            return
+        if self.deadband is not None and not self.deadband.should_publish(sensor, readings):
+            return
+        topic = self.sensor_topics[sensor]
+        if self.batcher is not None and self.batcher.handles(topic):
+            self.batcher.add(topic, readings)
+        else:
+            self.send_message(topic, self.encode_payload(topic, [readings]))
+
+    def publish_frame(self, topic, samples):
+        self.send_message(topic, self.encode_payload(topic, samples))
+
+    def send_message(self, topic, payload, retain=True):
+        if self.connected.is_set() and self.publish(topic, payload, retain):
+            return True
+        if self.spool is not None:
+            self.spool.append(topic, payload)
+            self.spooled += 1
+        return False
+
+    def publish(self, topic, payload, retain):
+        with self.inflight_lock:
+            # Bound messages handed to paho but not yet confirmed (written for QoS 0, acked for QoS 1/2)
+            if not self.inflight_lock.wait_for(lambda: len(self.inflight) < self.max_inflight, INFLIGHT_WAIT_SECS):
+                self.inflight_timeouts += 1
+                return False
+            info = self.mqtt_client.publish(topic, payload, qos=self.qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return False
+            if not info.is_published():
+                self.inflight.add(info.mid)
+            self.published += 1
+            return True
+
+    def on_publish(self, client, userdata, mid):
+        with self.inflight_lock:
+            self.inflight.discard(mid)
+            self.inflight_lock.notify_all()
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.client_on_disconnect is not None:
+            self.client_on_disconnect(client, userdata, rc)
+        if self.qos != 0:
+            return
+        # paho drops QoS 0 messages it has not written yet when it reconnects, they never get an on_publish
+        with self.inflight_lock:
+            self.lost_on_disconnect += len(self.inflight)
+            self.inflight.clear()
+            self.inflight_lock.notify_all()
+
+    def drain_spool(self, max_messages):
+        if self.spool is None or not self.connected.is_set():
+            return
+        # Not retained, a replayed sample must not replace the latest retained value
+        self.spool.drain(lambda topic, payload: self.connected.is_set() and self.publish(topic, payload, False),
+                         max_messages)
+
+    def _publish_loop(self):
+        last_drain = time.monotonic()
+        next_stats = time.monotonic() + self.stats_interval_secs
+        while not self.stop_event.is_set() or self.samples:
+            self.samples_ready.wait(PUBLISH_IDLE_WAIT_SECS)
+            self.samples_ready.clear()
+            while self.samples:
+                try:
+                    self.publish_data(*self.samples.popleft())
+                except Exception:
+                    self.publish_errors += 1
+                    if self.publish_errors == 1:
+                        l.exception("Publishing a sample failed, further errors are only counted")
+            if self.batcher is not None:
+                self.batcher.flush_expired()
+            now = time.monotonic()
+            if self.spool is not None and self.connected.is_set():
+                self.drain_spool(max(1, int((now - last_drain) * self.spool_drain_rate)))
+            last_drain = now
+            if self.stats_interval_secs > 0 and now >= next_stats:
+                self.log_stats()
+                next_stats = now + self.stats_interval_secs
+        if self.batcher is not None:
+            self.batcher.flush_all()
+
+    def _run_thread(self, target):
+        try:
+            target()
+        except Exception:
+            self.failure = threading.current_thread().name
+            l.exception("The %s thread failed" % self.failure)
+        finally:
+            # Neither thread is any use without the other
+            self.scheduler.stop()
+            self.stop_event.set()
+            self.samples_ready.set()
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._run_thread, args=(self.scheduler.run,),
+                                         name="sense-hat-sampling", daemon=True),
+                        threading.Thread(target=self._run_thread, args=(self._publish_loop,),
+                                         name="sense-hat-publishing", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.scheduler.stop()
+        self.stop_event.set()
+        self.samples_ready.set()
+        for thread in self.threads:
+            thread.join()
+
+    def wait(self):
+        # Returns once stop() was called or a thread failed, the timeout keeps Ctrl-C working
+        while not self.stop_event.wait(1.0):
+            pass
+
+    def stats(self):
+        return {
+            "sampled": self.sampled,
+            "queue_depth": len(self.samples),
+            "max_queue_depth": self.max_queue_depth,
+            "dropped_samples": self.dropped_samples,
+            "published": self.published,
+            "spooled": self.spooled,
+            "inflight": len(self.inflight),
+            "inflight_timeouts": self.inflight_timeouts,
+            "publish_errors": self.publish_errors,
+            "lost_on_disconnect": self.lost_on_disconnect,
+            "sensors": self.scheduler.stats()
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        l.info("Sampled %d, published %d, spooled %d, queue depth %d (max %d), dropped %d, in flight %d, "
+               "in flight timeouts %d, publish errors %d, lost on disconnect %d"
+               % (stats["sampled"], stats["published"], stats["spooled"], stats["queue_depth"],
+                  stats["max_queue_depth"], stats["dropped_samples"], stats["inflight"], stats["inflight_timeouts"],
+                  stats["publish_errors"], stats["lost_on_disconnect"]))
+        self.scheduler.log_stats()
+        if self.batcher is not None:
+            l.info("Sent %d samples in %d frames" % (self.batcher.samples_sent, self.batcher.frames_sent))
+        for sensor, aggregator in self.aggregators.items():
+            l.info("Aggregated %s into %d windows of %d samples" % (sensor, aggregator.windows,
+                                                                   len(aggregator.window)))
+        if self.deadband is not None:
+            l.info("Deadband published %d readings, suppressed %d" % (self.deadband.published,
+                                                                       self.deadband.suppressed))
+        if self.spool is not None:
+            l.info("Spooled %d messages, replayed %d" % (self.spool.spooled, self.spool.drained))
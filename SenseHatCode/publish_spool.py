@@ -0,0 +1,150 @@
+import os
+import struct
+import threading
+
+DEFAULT_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+SPOOL_SEGMENTS = 8
+RECORD_HEADER = struct.Struct("<HI")  # topic length, payload length
+OFFSET_FILE = "spool.offset"
+SEGMENT_PREFIX = "spool_"
+SEGMENT_SUFFIX = ".bin"
+
+
+class PublishSpool:
+    """Size capped, append-only on-disk queue of (topic, payload) messages.
+
+    The spool is split into segment files of max_bytes / SPOOL_SEGMENTS. When
+    appending would exceed max_bytes the oldest segment is deleted, so under a
+    long outage the oldest samples are given up first. The read position is
+    saved after every drain so a restart does not resend what already went out.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_SPOOL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(1, max_bytes // SPOOL_SEGMENTS)
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in os.listdir(path)
+                               if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        self.read_segment, self.read_offset = self._load_offset()
+        self.write_file = None
+        self.spooled = 0
+        self.drained = 0
+        self.dropped_bytes = 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "%s%08d%s" % (SEGMENT_PREFIX, segment, SEGMENT_SUFFIX))
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.path, OFFSET_FILE)) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0] if self.segments else 0), 0
+
+    def _save_offset(self):
+        tmp = os.path.join(self.path, OFFSET_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            f.write("%d %d" % (self.read_segment, self.read_offset))
+        os.replace(tmp, os.path.join(self.path, OFFSET_FILE))
+
+    def size_bytes(self):
+        return sum(os.path.getsize(self._segment_path(s)) for s in self.segments)
+
+    def __bool__(self):
+        with self.lock:
+            return self._has_data()
+
+    def _has_data(self):
+        if not self.segments:
+            return False
+        if len(self.segments) > 1 or self.read_segment < self.segments[-1]:
+            return True
+        if self.write_file is not None:
+            self.write_file.flush()
+        return self.read_offset < os.path.getsize(self._segment_path(self.segments[-1]))
+
+    def append(self, topic, payload):
+        topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        record = RECORD_HEADER.pack(len(topic), len(payload)) + topic + payload
+        with self.lock:
+            if self.write_file is None or self.write_file.tell() + len(record) > self.segment_bytes:
+                self._start_segment()
+            self.write_file.write(record)
+            self.spooled += 1
+
+    def _start_segment(self):
+        if self.write_file is not None:
+            self.write_file.close()
+        if self.segments:
+            segment = self.segments[-1] + 1
+        else:
+            segment, self.read_offset = self.read_segment, 0
+        self.segments.append(segment)
+        self.write_file = open(self._segment_path(segment), "ab")
+        # Stay under the cap by giving up the oldest segment
+        while len(self.segments) > SPOOL_SEGMENTS:
+            oldest = self.segments.pop(0)
+            self.dropped_bytes += os.path.getsize(self._segment_path(oldest))
+            os.remove(self._segment_path(oldest))
+            if self.read_segment <= oldest:
+                self.read_segment, self.read_offset = self.segments[0], 0
+
+    def drain(self, publish, max_messages):
+        """Calls publish(topic, payload) for up to max_messages of the oldest spooled messages.
+
+        publish returns False to stop early (e.g. the connection dropped again),
+        that message stays in the spool. Returns the number of messages sent.
+        """
+        sent = 0
+        with self.lock:
+            # The offset file is only rewritten when the read position moved, an idle drain writes nothing
+            start_position = (self.read_segment, self.read_offset)
+            if self.write_file is not None:
+                self.write_file.flush()
+            while sent < max_messages and self.segments:
+                if self.read_segment not in self.segments:
+                    self.read_segment, self.read_offset = self.segments[0], 0
+                path = self._segment_path(self.read_segment)
+                with open(path, "rb") as f:
+                    f.seek(self.read_offset)
+                    while sent < max_messages:
+                        header = f.read(RECORD_HEADER.size)
+                        if len(header) < RECORD_HEADER.size:
+                            break
+                        topic_len, payload_len = RECORD_HEADER.unpack(header)
+                        topic = f.read(topic_len).decode("utf-8")
+                        payload = f.read(payload_len)
+                        if not publish(topic, payload):
+                            if sent:
+                                self._save_offset()
+                            self.drained += sent
+                            return sent
+                        sent += 1
+                        self.read_offset = f.tell()
+                if sent >= max_messages or self.read_segment == self.segments[-1]:
+                    break
+                # Segment fully sent, remove it and move on to the next one
+                self.segments.remove(self.read_segment)
+                os.remove(path)
+                self.read_segment, self.read_offset = self.segments[0], 0
+            if self.segments and self.read_segment == self.segments[-1] and self.write_file is None \
+                    and self.read_offset >= os.path.getsize(self._segment_path(self.read_segment)):
+                os.remove(self._segment_path(self.read_segment))
+                self.segments = []
+                self.read_segment, self.read_offset = self.read_segment + 1, 0
+            if (self.read_segment, self.read_offset) != start_position:
+                self._save_offset()
+        self.drained += sent
+        return sent
+
+    def close(self):
+        with self.lock:
+            if self.write_file is not None:
+                self.write_file.close()
+                self.write_file = None
+            self._save_offset()
@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class SampleBatcher:
+    """Collects samples per topic and hands them on as one frame.
+
+    A topic's batch is flushed once it holds max_samples samples or its oldest
+    sample is older than max_age_ms, whichever comes first. Either limit can be
+    disabled by setting it to 0.
+    """
+
+    def __init__(self, topics, on_flush, max_samples=0, max_age_ms=0, clock=time.monotonic):
+        self.topics = set(topics)
+        self.on_flush = on_flush
+        self.max_samples = max_samples
+        self.max_age_secs = max_age_ms / 1000.0
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.batches = {topic: [] for topic in self.topics}
+        self.batch_started = {}
+        self.frames_sent = 0
+        self.samples_sent = 0
+
+    def handles(self, topic):
+        return topic in self.topics
+
+    def add(self, topic, sample):
+        frame = None
+        with self.lock:
+            batch = self.batches[topic]
+            if not batch:
+                self.batch_started[topic] = self.clock()
+            batch.append(sample)
+            if self.max_samples > 0 and len(batch) >= self.max_samples:
+                frame = self._take(topic)
+        if frame:
+            self._flush(topic, frame)
+
+    def flush_expired(self, now=None):
+        if self.max_age_secs <= 0:
+            return
+        now = self.clock() if now is None else now
+        frames = []
+        with self.lock:
+            for topic, batch in self.batches.items():
+                if batch and now - self.batch_started[topic] >= self.max_age_secs:
+                    frames.append((topic, self._take(topic)))
+        for topic, frame in frames:
+            self._flush(topic, frame)
+
+    def flush_all(self):
+        with self.lock:
+            frames = [(topic, self._take(topic)) for topic, batch in self.batches.items() if batch]
+        for topic, frame in frames:
+            self._flush(topic, frame)
+
+    def _take(self, topic):
+        frame = self.batches[topic]
+        self.batches[topic] = []
+        return frame
+
+    def _flush(self, topic, frame):
+        self.frames_sent += 1
+        self.samples_sent += len(frame)
+        self.on_flush(topic, frame)
@@ -0,0 +1,106 @@
+import math
+import random
+import time
+
+GRAVITY_G = 1.0
+# Slow motion of the simulated board, periods in seconds
+ROLL_PERIOD_SECS = 7.0
+PITCH_PERIOD_SECS = 11.0
+YAW_RATE_DEG_PER_SEC = 3.0
+ENVIRONMENT_PERIOD_SECS = 600.0
+
+
+class SimulatedSenseHat:
+    """Drop-in stand-in for sense_hat.SenseHat that needs no Pi.
+
+    The board slowly rocks in roll and pitch and turns in yaw, accelerometer
+    readings are gravity projected onto that attitude, the gyroscope is its
+    rate of change and the environment sensors drift over minutes. Every
+    reading is a function of the clock plus Gaussian noise, so any read rate
+    yields a consistent signal. read_delay_secs adds a sleep per read to mimic
+    the I2C bus of the real board.
+    """
+
+    def __init__(self, seed=None, noise=1.0, read_delay_secs=0.0, clock=time.time):
+        self.random = random.Random(seed)
+        self.noise = noise
+        self.read_delay_secs = read_delay_secs
+        self.clock = clock
+        self.start = clock()
+
+    def set_imu_config(self, compass_enabled, gyro_enabled, accel_enabled):
+        pass
+
+    def _read(self):
+        if self.read_delay_secs > 0:
+            time.sleep(self.read_delay_secs)
+        return self.clock() - self.start
+
+    def _noise(self, sigma):
+        return self.random.gauss(0.0, sigma * self.noise)
+
+    @staticmethod
+    def _attitude(t):
+        # Radians
+        roll = math.radians(20) * math.sin(2 * math.pi * t / ROLL_PERIOD_SECS)
+        pitch = math.radians(10) * math.sin(2 * math.pi * t / PITCH_PERIOD_SECS)
+        yaw = math.radians(YAW_RATE_DEG_PER_SEC * t) % (2 * math.pi)
+        return roll, pitch, yaw
+
+    @staticmethod
+    def _attitude_rate(t):
+        # Radians per second
+        roll_rate = math.radians(20) * 2 * math.pi / ROLL_PERIOD_SECS * math.cos(2 * math.pi * t / ROLL_PERIOD_SECS)
+        pitch_rate = math.radians(10) * 2 * math.pi / PITCH_PERIOD_SECS * math.cos(2 * math.pi * t / PITCH_PERIOD_SECS)
+        return roll_rate, pitch_rate, math.radians(YAW_RATE_DEG_PER_SEC)
+
+    def _degrees(self, t, sigma):
+        return {name: math.degrees(angle) % 360 + self._noise(sigma)
+                for name, angle in zip(("roll", "pitch", "yaw"), self._attitude(t))}
+
+    def get_humidity(self):
+        t = self._read()
+        return 45 + 5 * math.sin(2 * math.pi * t / ENVIRONMENT_PERIOD_SECS) + self._noise(0.2)
+
+    def get_temperature(self):
+        t = self._read()
+        return 24 + 2 * math.sin(2 * math.pi * t / ENVIRONMENT_PERIOD_SECS + 1) + self._noise(0.05)
+
+    def get_temperature_from_pressure(self):
+        return self.get_temperature() - 0.5 + self._noise(0.05)
+
+    def get_pressure(self):
+        t = self._read()
+        return 1013.25 + 3 * math.sin(2 * math.pi * t / (4 * ENVIRONMENT_PERIOD_SECS)) + self._noise(0.1)
+
+    def get_compass(self):
+        return math.degrees(self._attitude(self._read())[2]) % 360 + self._noise(1.0)
+
+    def get_orientation_degrees(self):
+        return self._degrees(self._read(), 0.1)
+
+    @property
+    def accel(self):
+        # Orientation from the accelerometer only, noisier and yaw free
+        orientation = self._degrees(self._read(), 0.5)
+        orientation["yaw"] = 0.0
+        return orientation
+
+    @property
+    def accel_raw(self):
+        roll, pitch, _ = self._attitude(self._read())
+        return {
+            "x": -GRAVITY_G * math.sin(pitch) + self._noise(0.01),
+            "y": GRAVITY_G * math.sin(roll) * math.cos(pitch) + self._noise(0.01),
+            "z": GRAVITY_G * math.cos(roll) * math.cos(pitch) + self._noise(0.01)
+        }
+
+    @property
+    def gyroscope(self):
+        # Orientation from the gyroscope only, drifts in yaw like the real one
+        return self._degrees(self._read(), 0.2)
+
+    @property
+    def gyroscope_raw(self):
+        rates = self._attitude_rate(self._read())
+        return {axis: rate + self._noise(0.005) for axis, rate in zip(("x", "y", "z"), rates)}
@@ -0,0 +1,80 @@
+import struct
+
+# Fixed layout binary payloads, shared by the publisher and the reader.
+#
+#   header : magic "SH", schema version (uint8), sensor id (uint8), sample count (uint16)
+#   record : ts as float64 followed by one float32 per schema field, repeated count times
+#
+# Everything is little endian. JSON payloads always start with "{" so the two
+# formats can be told apart from the first byte of a message.
+
+MAGIC = b"SH"
+SCHEMA_VERSION = 1
+HEADER = struct.Struct("<2sBBH")
+MAX_SAMPLES_PER_PAYLOAD = 0xFFFF
+
+# Per window summaries of the raw IMU, a field per axis and statistic, e.g. x_rms
+IMU_WINDOW_STATS = ("mean", "var", "min", "max", "rms", "p2p")
+IMU_WINDOW_FIELDS = tuple("%s_%s" % (axis, stat) for axis in ("x", "y", "z") for stat in IMU_WINDOW_STATS)
+
+SENSOR_SCHEMAS = {
+    1: ("basic_sensor", ("humidity", "temperature_c", "temperature_from_pressure", "pressure_millibars",
+                         "compass_north")),
+    2: ("accel", ("roll", "pitch", "yaw")),
+    3: ("accel_raw", ("x", "y", "z")),
+    4: ("gyro", ("roll", "pitch", "yaw")),
+    5: ("gyro_raw", ("x", "y", "z")),
+    6: ("orientation", ("roll", "pitch", "yaw")),
+    7: ("accel_raw_stats", IMU_WINDOW_FIELDS),
+    8: ("gyro_raw_stats", IMU_WINDOW_FIELDS),
+}
+
+SENSOR_IDS = {name: sensor_id for sensor_id, (name, _) in SENSOR_SCHEMAS.items()}
+RECORDS = {sensor_id: struct.Struct("<d" + "f" * len(fields)) for sensor_id, (_, fields) in SENSOR_SCHEMAS.items()}
+
+# Device ids are one level of sense_hat/<device id>/data/<sensor> and the reader's history directory name
+INVALID_DEVICE_ID_CHARS = "/+#"
+RESERVED_DEVICE_IDS = (".", "..")
+
+
+def valid_device_id(device_id):
+    return (bool(device_id) and device_id not in RESERVED_DEVICE_IDS
+            and not any(c in device_id for c in INVALID_DEVICE_ID_CHARS))
+
+
+def is_binary(payload):
+    return payload[:2] == MAGIC
+
+
+def encode(sensor, samples):
+    sensor_id = SENSOR_IDS[sensor]
+    fields = SENSOR_SCHEMAS[sensor_id][1]
+    if len(samples) > MAX_SAMPLES_PER_PAYLOAD:
+        raise ValueError("Too many samples for one payload: %d" % len(samples))
+    record = RECORDS[sensor_id]
+    parts = [HEADER.pack(MAGIC, SCHEMA_VERSION, sensor_id, len(samples))]
+    for sample in samples:
+        parts.append(record.pack(sample["ts"], *[sample[f] for f in fields]))
+    return b"".join(parts)
+
+
+def decode_records(payload):
+    # Returns (sensor, [(ts, value, ...), ...]) with values in SENSOR_SCHEMAS field order
+    magic, version, sensor_id, count = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("Not a binary sensor payload")
+    if version != SCHEMA_VERSION:
+        raise ValueError("Unsupported binary schema version %d" % version)
+    if sensor_id not in SENSOR_SCHEMAS:
+        raise ValueError("Unknown sensor id %d" % sensor_id)
+    sensor, fields = SENSOR_SCHEMAS[sensor_id]
+    record = RECORDS[sensor_id]
+    if len(payload) != HEADER.size + count * record.size:
+        raise ValueError("Truncated %s payload" % sensor)
+    return sensor, list(record.iter_unpack(memoryview(payload)[HEADER.size:]))
+
+
+def decode(payload):
+    sensor, records = decode_records(payload)
+    keys = ("ts",) + SENSOR_SCHEMAS[SENSOR_IDS[sensor]][1]
+    return sensor, [dict(zip(keys, values)) for values in records]
@@ -0,0 +1,112 @@
+import threading
+import time
+import logging as l
+
+
+class ScheduledTask:
+
+    def __init__(self, name, rate_hz, func):
+        self.name = name
+        self.rate_hz = rate_hz
+        # A rate of 0 (or less) means run on every pass of the scheduler
+        self.period = 1.0 / rate_hz if rate_hz > 0 else 0.0
+        self.func = func
+        self.next_deadline = None
+        self.runs = 0
+        self.overruns = 0
+        self.missed_slots = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            "rate_hz": self.rate_hz,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "missed_slots": self.missed_slots,
+            "mean_lateness_ms": round(self.total_lateness / self.runs * 1000, 3) if self.runs else 0.0,
+            "max_lateness_ms": round(self.max_lateness * 1000, 3),
+            "errors": self.errors
+        }
+
+
+class SensorScheduler:
+    """Runs each registered task at its own rate against time.monotonic().
+
+    Deadlines advance by a whole period from the previous deadline rather than
+    from the time the task actually ran, so the schedule does not drift. A task
+    that falls one or more periods behind is counted as an overrun and skips the
+    missed slots instead of bursting to catch up. A task raising an exception
+    is counted (its first error logged) and keeps its schedule, so one failing
+    sensor does not stop the others.
+    """
+
+    def __init__(self, stats_interval_secs=0, clock=time.monotonic):
+        self.tasks = {}
+        self.clock = clock
+        self.stats_interval_secs = stats_interval_secs
+        self.stop_event = threading.Event()
+
+    def add_task(self, name, rate_hz, func):
+        self.tasks[name] = ScheduledTask(name, rate_hz, func)
+
+    def run_pending(self, now):
+        for task in self.tasks.values():
+            if task.next_deadline is None:
+                task.next_deadline = now
+            if now < task.next_deadline:
+                continue
+
+            lateness = now - task.next_deadline
+            task.max_lateness = max(task.max_lateness, lateness)
+            task.total_lateness += lateness
+            try:
+                task.func()
+            except Exception:
+                task.errors += 1
+                if task.errors == 1:
+                    l.exception("Sensor %s failed, further errors are only counted" % task.name)
+            task.runs += 1
+
+            if task.period == 0:
+                task.next_deadline = now
+                continue
+            task.next_deadline += task.period
+            if lateness >= task.period:
+                missed = int(lateness // task.period)
+                task.overruns += 1
+                task.missed_slots += missed
+                task.next_deadline += missed * task.period
+
+    def time_to_next_deadline(self, now):
+        deadlines = [t.next_deadline for t in self.tasks.values() if t.next_deadline is not None]
+        if not deadlines:
+            return 0.0
+        return max(0.0, min(deadlines) - now)
+
+    def stats(self):
+        return {name: task.stats() for name, task in self.tasks.items()}
+
+    def log_stats(self):
+        for name, task in self.tasks.items():
+            s = task.stats()
+            l.info("Sensor %s: rate %.2f Hz, runs %d, overruns %d, missed slots %d, "
+                   "lateness mean %.3f ms max %.3f ms, errors %d" % (name, s["rate_hz"], s["runs"], s["overruns"],
+                                                                     s["missed_slots"], s["mean_lateness_ms"],
+                                                                     s["max_lateness_ms"], s["errors"]))
+
+    def run(self):
+        next_stats = self.clock() + self.stats_interval_secs
+        while not self.stop_event.is_set():
+            now = self.clock()
+            self.run_pending(now)
+            if self.stats_interval_secs > 0 and now >= next_stats:
+                self.log_stats()
+                next_stats = now + self.stats_interval_secs
+            wait = self.time_to_next_deadline(self.clock())
+            if wait > 0:
+                self.stop_event.wait(wait)
+
+    def stop(self):
+        self.stop_event.set()
@@ -1,17 +1,36 @@
+import argparse
+
 import dash
 
 
 from dash import dash_table
 from dash import dcc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dash import html
 from datetime import datetime as dt
 import plotly
 import plotly.graph_objs as go
 import sensor_data_mqtt_reader
+import sensor_capture
+import sensor_metrics
+import sensor_event_stream
+import sensor_shared_memory
+from dash_incremental_updates import incremental_window, extend_data, nothing_new, render_key, pushed
+from render_cache import RenderCache
 
 app = dash.Dash(__name__, title="Live Sensor Updates")
-sensor_data_reader = sensor_data_mqtt_reader.SensorDataReader()
+# Under several workers set SENSE_HAT_SHARED_MEMORY so they all read one ingest process
+sensor_data_reader = sensor_shared_memory.reader_from_environment()
+# Prometheus text at /metrics: ingest counters from the reader plus callback timings
+sensor_metrics.instrument_dash(app, sensor_data_reader.metrics)
+# New accel samples are pushed to the browser over Server-Sent Events, polling remains the fallback
+sensor_event_stream.install_event_stream(app, sensor_data_reader)
+# Bump when a figure layout changes so open clients fetch the full figure again
+GRAPH_LAYOUT_VERSION = 1
+render_cache = RenderCache()
+TABLE_PAGE_SIZE = 25
+# With --history_dir the tables page through this much history instead of the ring buffers
+TABLE_WINDOW_SECS = 10 * 60
 
 table_data_style = {
     'backgroundColor': 'rgb(50, 50, 50)',
@@ -28,10 +47,16 @@ default_fig = go.Figure(plotly.graph_objs.Scatter3d())
 app.layout = html.Div(
     html.Div([
         html.H4('Live Sensor Data'),
+        dcc.Dropdown(id='device-select', value=sensor_data_mqtt_reader.DEFAULT_DEVICE, clearable=False),
         html.Div(id='live-update-text'),
         html.H5('Accelorometer Data'),
 
         dcc.Graph(id='live-accel-graph', animate=False, figure=default_fig),
+        dcc.Store(id='accel-graph-state'),
+        dcc.Store(id='accel-graph-stream'),
+        dcc.Store(id='sensor-accel-data-table-version'),
+        dcc.Store(id='sensor-gyro-data-table-version'),
+        dcc.Store(id='sensor-orientation-data-table-version'),
         dash_table.DataTable(
             id='sensor-accel-data-table',
             columns=[
@@ -43,8 +68,12 @@ app.layout = html.Div(
                 {"name": ["Accel", "Raw", "Y"], "id": "accel_y"},
                 {"name": ["Accel", "Raw", "Z"], "id": "accel_z"},
             ],
-            sort_action="native",
+            page_action="custom",
+            page_current=0,
+            page_size=TABLE_PAGE_SIZE,
+            sort_action="custom",
             sort_mode="multi",
+            sort_by=[],
             column_selectable="single",
             merge_duplicate_headers=True,
             style_header=table_header_style,
@@ -63,6 +92,12 @@ app.layout = html.Div(
                 {"name": ["Gyro", "Raw", "Y"], "id": "gyro_y"},
                 {"name": ["Gyro", "Raw", "Z"], "id": "gyro_z"},
             ],
+            page_action="custom",
+            page_current=0,
+            page_size=TABLE_PAGE_SIZE,
+            sort_action="custom",
+            sort_mode="multi",
+            sort_by=[],
             merge_duplicate_headers=True,
             style_header=table_header_style,
             style_data=table_data_style,
@@ -77,6 +112,12 @@ app.layout = html.Div(
                 {"name": "Pitch", "id": "pitch"},
                 {"name": "Yaw", "id": "yaw"},
             ],
+            page_action="custom",
+            page_current=0,
+            page_size=TABLE_PAGE_SIZE,
+            sort_action="custom",
+            sort_mode="multi",
+            sort_by=[],
             merge_duplicate_headers=True,
             style_header=table_header_style,
             style_data=table_data_style,
@@ -91,14 +132,43 @@ app.layout = html.Div(
 )
 
 
-@app.callback(Output('live-accel-graph', 'figure'),
-              Input('interval-component', 'n_intervals'))
-def update_accel_raw(n):
-    accel_data = sensor_data_reader.accel_data_q[-1]
+@app.callback([Output('live-accel-graph', 'figure'),
+               Output('live-accel-graph', 'extendData'),
+               Output('accel-graph-state', 'data')],
+              Input('interval-component', 'n_intervals'),
+              Input('device-select', 'value'),
+              State('accel-graph-state', 'data'))
+def update_accel_raw(n, device_id, client_state):
+    buffer = sensor_data_reader.device(device_id).accel_data_q
+    # Switching device changes what the graph shows, so it counts as a layout change
+    full_refresh, accel, new_state = incremental_window(buffer, client_state,
+                                                       "%d:%s" % (GRAPH_LAYOUT_VERSION, device_id))
+    if not full_refresh and (nothing_new(accel) or pushed(client_state)):
+        return [dash.no_update] * 3
+    key = render_key('accel-graph', full_refresh, client_state, new_state)
+    if full_refresh:
+        return [render_cache.get_or_render(key, lambda: render_accel_figure(accel)), dash.no_update, new_state]
+    return [dash.no_update,
+            render_cache.get_or_render(
+                key, lambda: extend_data(dict(x=[accel["yaw"]], y=[accel["roll"]], z=[accel["pitch"]]),
+                                         buffer.capacity)),
+            new_state]
+
+
+app.clientside_callback(
+    sensor_event_stream.stream_subscriber('live-accel-graph', 'accel-graph-state', 'accel',
+                                          {'x': ['yaw'], 'y': ['roll'], 'z': ['pitch']}, sensor_data_reader.queue_len),
+    Output('accel-graph-stream', 'data'),
+    Input('accel-graph-state', 'data'),
+    State('device-select', 'value')
+)
+
+
+def render_accel_figure(accel):
     data_3d = plotly.graph_objs.Scatter3d(
-        x=[point["yaw"] for point in sensor_data_reader.accel_data_q],
-        y=[point["roll"] for point in sensor_data_reader.accel_data_q],
-        z=[point["pitch"] for point in sensor_data_reader.accel_data_q],
+        x=accel["yaw"],
+        y=accel["roll"],
+        z=accel["pitch"],
         mode='markers+lines',
         marker_size=3
     )
@@ -109,32 +179,79 @@ def update_accel_raw(n):
                                    yaxis=dict(nticks=8, range=[0, 360], ),
                                    zaxis=dict(nticks=8, range=[0, 360], ), ),
                                )
-    return figure
+    return figure.to_plotly_json()
 
-@app.callback(Output('live-update-text', 'children'),
+@app.callback(Output('device-select', 'options'),
               Input('interval-component', 'n_intervals'))
-def update_header(n):
+def update_device_options(n):
+    return sensor_data_reader.device_ids()
+
+
+@app.callback(Output('live-update-text', 'children'),
+              Input('interval-component', 'n_intervals'),
+              Input('device-select', 'value'))
+def update_header(n, device_id):
     style = {'padding': '5px', 'fontSize': '14px'}
     i = dt.utcnow()
     date_time = f"""{i:%Y-%m-%d %H:%M:%S}.{"{:03d}".format(i.microsecond // 1000)}"""
-    latest_data = sensor_data_reader.simple_data_q[-1]
+    latest_data = sensor_data_reader.device(device_id).simple_data_q.latest()
+    if latest_data is None:
+        return [html.Span(date_time + " Waiting for sensor data", style=style)]
     return [
         html.Span(date_time + " Humidity : {:.2f} Temp(C) : {:.2f} Pressure(millibar) {:.3f}".format(latest_data["humidity"],latest_data["temperature_c"],latest_data["pressure_millibars"]) , style=style),
     ]
 
 
-@app.callback([
-                Output('sensor-accel-data-table', 'data'),
-                Output('sensor-gyro-data-table', 'data'),
-                Output('sensor-orientation-data-table', 'data')],
-              Input('interval-component', 'n_intervals'))
-def update_sensor_simple_data(n):
-    return [list(sensor_data_reader.accel_data_q),list(sensor_data_reader.gyro_data_q),list(sensor_data_reader.ori_data_q)]
+def register_table_callback(table_id, stream):
+    # One callback per table so paging or sorting one table only queries that table
+    @app.callback([Output(table_id, 'data'),
+                   Output(table_id, 'page_count'),
+                   Output(table_id + '-version', 'data')],
+                  Input('interval-component', 'n_intervals'),
+                  Input('device-select', 'value'),
+                  Input(table_id, 'page_current'),
+                  Input(table_id, 'page_size'),
+                  Input(table_id, 'sort_by'),
+                  State(table_id + '-version', 'data'))
+    def update_sensor_table(n, device_id, page, page_size, sort_by, client_version):
+        page = page or 0
+        sort_by = sort_by or []
+        version = [device_id, sensor_data_reader.version(stream, device_id), page, page_size, sort_by]
+        if version == client_version:
+            return [dash.no_update] * 3
+        key = ('table', device_id, stream, version[1], page, page_size,
+               tuple((s["column_id"], s["direction"]) for s in sort_by))
+        records, total = render_cache.get_or_render(
+            key, lambda: sensor_data_reader.query_page(stream, page, page_size, sort_by, device_id, TABLE_WINDOW_SECS))
+        return [records, max(1, -(-total // page_size)), version]
 
+    return update_sensor_table
 
 
+for table_id, stream in [('sensor-accel-data-table', 'accel'),
+                         ('sensor-gyro-data-table', 'gyro'),
+                         ('sensor-orientation-data-table', 'orientation')]:
+    register_table_callback(table_id, stream)
 
 
 if __name__ == '__main__':
-    sensor_data_reader.init_and_start_mqtt()
-    app.run_server(debug=True)
+    parser = argparse.ArgumentParser(description="Dash app showing live Sense Hat data")
+    sensor_capture.add_arguments(parser)
+    parser.add_argument("--history_dir", default=None,
+                        help="Keep every sample on disk here, the tables then page through the last %d minutes"
+                             % (TABLE_WINDOW_SECS // 60))
+    args = parser.parse_args()
+    attached = isinstance(sensor_data_reader, sensor_shared_memory.SharedSensorDataReader)
+    if args.history_dir and attached:
+        parser.error("--history_dir is kept by the ingest process, pass it to sensor_shared_memory.py instead of "
+                     "setting " + sensor_shared_memory.SHARED_MEMORY_ENV)
+    if args.history_dir:
+        sensor_data_reader.open_history(args.history_dir)
+    if attached:
+        print("Reading sensor data shared by the ingest process")
+    else:
+        sensor_capture.start_reader(sensor_data_reader, args)
+    try:
+        app.run_server(debug=True)
+    finally:
+        sensor_data_reader.close()
@@ -0,0 +1,150 @@
+// Appends samples pushed by sensor_event_stream.py to Dash graphs, see stream_subscriber() there.
+window.sensorEventStream = (function () {
+    // One EventSource per device and stream, shared by every graph showing that stream
+    var sources = {};
+    // graph id -> key of the source it listens to
+    var graphSources = {};
+    // source key -> time the stream last failed, polling is used until retry_ms later
+    var failures = {};
+
+    function setProps(id, props) {
+        var clientside = window.dash_clientside;
+        if (clientside && clientside.set_props) {
+            clientside.set_props(id, props);
+            return true;
+        }
+        return false;
+    }
+
+    function extendGraph(graphId, update, traceIndices, maxPoints) {
+        if (setProps(graphId, {extendData: [update, traceIndices, maxPoints]})) {
+            return;
+        }
+        // Older Dash without set_props, extend the plotly graph directly
+        var graph = document.getElementById(graphId);
+        var plot = graph && graph.querySelector('.js-plotly-plot');
+        if (plot) {
+            Plotly.extendTraces(plot, update, traceIndices, maxPoints);
+        }
+    }
+
+    function slowDown(listener) {
+        if (listener.config.interval_id) {
+            setProps(listener.config.interval_id, {interval: listener.config.poll_interval_ms});
+        }
+    }
+
+    function deliver(listener, samples) {
+        // A source shared with graphs further behind also sends samples this graph already has
+        var count = samples.ts.length;
+        var skip = listener.state.seq - (samples.seq - count);
+        if (skip >= count) {
+            return;
+        }
+        var update = {};
+        listener.props.forEach(function (prop) {
+            update[prop] = listener.config.traces[prop].map(function (field) {
+                return skip > 0 ? samples[field].slice(skip) : samples[field];
+            });
+        });
+        extendGraph(listener.config.graph_id, update, listener.traceIndices, listener.config.max_points);
+        listener.state = Object.assign({}, listener.state, {seq: samples.seq});
+        setProps(listener.config.state_id, {data: listener.state});
+    }
+
+    function fallBack(key) {
+        // A 404 or a dropped connection: back to polling for every graph on this stream
+        var shared = sources[key];
+        shared.source.close();
+        delete sources[key];
+        failures[key] = Date.now();
+        Object.keys(shared.listeners).forEach(function (graphId) {
+            var listener = shared.listeners[graphId];
+            delete graphSources[graphId];
+            if (listener.config.interval_id) {
+                setProps(listener.config.interval_id, {interval: listener.config.interval_ms});
+            }
+            var state = Object.assign({}, listener.state);
+            delete state.push;
+            setProps(listener.config.state_id, {data: state});
+        });
+    }
+
+    function open(key, shared, deviceId, config, seq) {
+        if (shared.source) {
+            shared.source.close();
+        }
+        var url = config.path + '/' + encodeURIComponent(deviceId) + '/' + config.stream + '?seq=' + seq;
+        var source = new window.EventSource(url);
+        shared.source = source;
+        shared.seq = seq;
+        source.onopen = function () {
+            Object.keys(shared.listeners).forEach(function (graphId) { slowDown(shared.listeners[graphId]); });
+        };
+        source.onmessage = function (event) {
+            var samples = JSON.parse(event.data);
+            shared.seq = samples.seq;
+            Object.keys(shared.listeners).forEach(function (graphId) {
+                deliver(shared.listeners[graphId], samples);
+            });
+        };
+        source.onerror = function () {
+            if (sources[key] === shared && shared.source === source) {
+                fallBack(key);
+            }
+        };
+    }
+
+    function unsubscribe(graphId) {
+        var key = graphSources[graphId];
+        var shared = key && sources[key];
+        delete graphSources[graphId];
+        if (!shared) {
+            return;
+        }
+        delete shared.listeners[graphId];
+        if (Object.keys(shared.listeners).length === 0) {
+            shared.source.close();
+            delete sources[key];
+        }
+    }
+
+    function subscribe(state, deviceId, config) {
+        var noUpdate = window.dash_clientside.no_update;
+        if (!window.EventSource || !state) {
+            return 'polling';
+        }
+        if (state.push) {
+            // Our own seq update coming back round, the subscription is current
+            return noUpdate;
+        }
+        var key = deviceId + '/' + config.stream;
+        if (failures[key] && Date.now() - failures[key] < config.retry_ms) {
+            return 'polling';
+        }
+        // A state without the push flag comes from the server, the graph holds every sample up to its seq
+        unsubscribe(config.graph_id);
+        var listener = {
+            config: config,
+            state: Object.assign({}, state, {push: true}),
+            props: Object.keys(config.traces),
+            traceIndices: config.traces[Object.keys(config.traces)[0]].map(function (field, i) { return i; })
+        };
+        var shared = sources[key];
+        if (!shared) {
+            shared = sources[key] = {listeners: {}};
+            open(key, shared, deviceId, config, state.seq);
+        } else if (state.seq < shared.seq) {
+            // This graph is further behind than the shared stream, restart it from here, the others skip repeats
+            open(key, shared, deviceId, config, state.seq);
+        } else if (shared.source.readyState === window.EventSource.OPEN) {
+            slowDown(listener);
+        }
+        shared.listeners[config.graph_id] = listener;
+        graphSources[config.graph_id] = key;
+        setProps(config.state_id, {data: listener.state});
+        return 'push';
+    }
+
+    return {subscribe: subscribe};
+})();
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def incremental_window(buffer, client_state, layout_version, refresh_after=None):
+    """Works out what a graph client needs from a ColumnarRingBuffer.
+
+    client_state is what the previous call returned for this client (kept in a
+    dcc.Store), None on first load. Returns (full_refresh, columns, new_state):
+    a full refresh carries every retained sample, otherwise columns only holds
+    the samples that arrived since the client's last sequence number. A full
+    refresh is also forced when the layout version changed or when the client
+    fell further behind than the buffer retains. When the full figure is
+    downsampled, refresh_after bounds how many raw samples get appended to it
+    before the next full (downsampled) refresh. The columns are consistent
+    copies (a shared snapshot for full refreshes), a write landing meanwhile
+    cannot change them.
+    """
+    full_refresh = (client_state is None
+                    or client_state.get("layout") != layout_version
+                    or not buffer.count - buffer.capacity <= client_state.get("seq", -1) <= buffer.count
+                    or (refresh_after is not None and buffer.count - client_state.get("full_seq", 0) > refresh_after))
+    if full_refresh:
+        snapshot = buffer.snapshot()
+        start_seq, columns = snapshot.first_seq, snapshot.columns()
+    else:
+        start_seq, columns = buffer.consistent_since(client_state["seq"])
+    new_seq = start_seq + len(columns["ts"])
+    new_state = {"seq": new_seq, "layout": layout_version,
+                 "full_seq": new_seq if full_refresh else client_state.get("full_seq", 0)}
+    return full_refresh, columns, new_state
+
+
+def extend_data(trace_columns, max_points):
+    """Builds an extendData value from {trace property: [one array per trace]}.
+
+    The arrays are copied, buffer views would otherwise change under a cached value.
+    """
+    trace_columns = {prop: [np.array(values) for values in arrays] for prop, arrays in trace_columns.items()}
+    no_of_traces = len(next(iter(trace_columns.values())))
+    return [trace_columns, list(range(no_of_traces)), max_points]
+
+
+def render_key(name, full_refresh, client_state, new_state, *extra):
+    # Clients at the same position in a stream share one rendering
+    start = None if full_refresh else client_state["seq"]
+    return (name, new_state["layout"], start, new_state["seq"]) + tuple(extra)
+
+
+def nothing_new(columns):
+    return len(columns["ts"]) == 0
+
+
+def pushed(client_state):
+    # The client receives new samples from the push stream, polling only sends full figures
+    return bool(client_state and client_state.get("push"))
@@ -0,0 +1,72 @@
+import numpy as np
+
+LTTB = "lttb"
+MIN_MAX = "min_max"
+DEFAULT_POINTS_PER_PIXEL = 2
+
+
+def target_points(width_px, points_per_pixel=DEFAULT_POINTS_PER_PIXEL, minimum=100):
+    return max(minimum, int((width_px or 0) * points_per_pixel))
+
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets, returns the indices of the points to keep.
+
+    Keeps the first and last point and from every bucket in between the point
+    forming the largest triangle with the point kept from the previous bucket
+    and the average of the next bucket. Each bucket is evaluated as a whole
+    with NumPy, only the walk over buckets is a Python loop.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    bucket_x_means = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / np.diff(edges)
+    bucket_y_means = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / np.diff(edges)
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 1 < n_out - 2:
+            next_x, next_y = bucket_x_means[i + 1], bucket_y_means[i + 1]
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def min_max_indices(y, n_out):
+    """Keeps the minimum and maximum of each of n_out / 2 equal sized buckets, in time order."""
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    no_of_buckets = n_out // 2
+    bucket_size = -(-n // no_of_buckets)
+    padded = np.full(no_of_buckets * bucket_size, np.nan)
+    padded[:n] = y
+    buckets = padded.reshape(no_of_buckets, bucket_size)
+    valid = ~np.all(np.isnan(buckets), axis=1)
+    offsets = np.arange(no_of_buckets)[valid] * bucket_size
+    mins = np.nanargmin(buckets[valid], axis=1) + offsets
+    maxs = np.nanargmax(buckets[valid], axis=1) + offsets
+    return np.unique(np.concatenate([mins, maxs]))
+
+
+def downsample(columns, y_field, n_out, method=LTTB):
+    """Returns columns (a dict of equal length arrays with "ts") reduced to about n_out points for y_field."""
+    if len(columns["ts"]) <= n_out:
+        return columns
+    if method == LTTB:
+        indices = lttb_indices(columns["ts"], columns[y_field], n_out)
+    elif method == MIN_MAX:
+        indices = min_max_indices(columns[y_field], n_out)
+    else:
+        raise ValueError("Unknown downsampling method " + str(method))
+    return {name: values[indices] for name, values in columns.items()}
@@ -0,0 +1,38 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_RENDER_CACHE_SIZE = 64
+
+
+class RenderCache:
+    """Bounded LRU of rendered callback outputs shared by every client of a Dash app.
+
+    Keys should include the stream version(s) the output was rendered from, so
+    all clients asking for the same version reuse one rendering.
+    """
+
+    def __init__(self, maxsize=DEFAULT_RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        # Render outside the lock, two clients racing on a new version may both render it once
+        value = render()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,253 @@
+import argparse
+import json
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+
+from sensor_schema_registry import SCHEMAS
+
+FIRING = "firing"
+RESOLVED = "resolved"
+# Outside sense_hat/# so readers subscribed to the sensor data do not receive their own alerts
+ALERT_TOPIC_ROOT = "sense_hat_alerts"
+
+OVER_TEMPERATURE_C = 40.0
+PRESSURE_DROP_MILLIBARS = 3.0
+PRESSURE_DROP_WINDOW_SECS = 60 * 60
+TILT_LIMIT_DEGREES = 30.0
+
+
+def tilt_degrees(angle):
+    # Sense Hat angles run 0..360, tilt is the distance from level either way
+    return abs((angle + 180.0) % 360.0 - 180.0)
+
+
+class Alert:
+
+    def __init__(self, rule, device_id, state, ts, value):
+        self.rule = rule
+        self.device_id = device_id
+        self.state = state
+        self.ts = ts
+        self.value = value
+
+    def to_dict(self):
+        return {"rule": self.rule, "device": self.device_id, "state": self.state, "ts": self.ts, "value": self.value}
+
+
+class RuleState:
+
+    def __init__(self):
+        self.active = False
+        # ts of the first sample of the current breach, None while within limits
+        self.breached_since = None
+        self.window = deque()
+
+
+class Threshold:
+    """Fires when a field goes above or below a limit and stays there for sustain_secs.
+
+    Once firing it only resolves when the value is back within the limit by
+    hysteresis, so a reading hovering around the limit does not flap.
+    transform is applied to the raw field value first, e.g. tilt_degrees.
+    """
+
+    def __init__(self, name, stream, field, above=None, below=None, hysteresis=0.0, sustain_secs=0.0,
+                 transform=None):
+        if above is None and below is None:
+            raise ValueError("Rule %s needs an above or a below limit" % name)
+        self.name = name
+        self.stream = stream
+        self.field = field
+        self.above = above
+        self.below = below
+        self.hysteresis = hysteresis
+        self.sustain_secs = sustain_secs
+        self.transform = transform
+
+    def measure(self, state, ts, value):
+        return value
+
+    def breached(self, value, active):
+        if self.above is not None and value > (self.above - self.hysteresis if active else self.above):
+            return True
+        return self.below is not None and value < (self.below + self.hysteresis if active else self.below)
+
+
+class RateOfChange(Threshold):
+    """Like Threshold, on how much the field changed over the last window_secs.
+
+    The window holds the samples since the newest one at least window_secs
+    old, each sample is appended and dropped once, so updates are O(1)
+    amortised. Nothing is measured until window_secs of samples are in.
+    """
+
+    def __init__(self, name, stream, field, window_secs, **kwargs):
+        super().__init__(name, stream, field, **kwargs)
+        self.window_secs = window_secs
+
+    def measure(self, state, ts, value):
+        window = state.window
+        window.append((ts, value))
+        start = ts - self.window_secs
+        while len(window) > 1 and window[1][0] <= start:
+            window.popleft()
+        if window[0][0] > start:
+            return None
+        return value - window[0][1]
+
+
+class LogSink:
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+
+    def __call__(self, alert):
+        level = logging.WARNING if alert.state == FIRING else logging.INFO
+        self.logger.log(level, "Alert %s %s on %s, value %.3f", alert.rule, alert.state, alert.device_id, alert.value)
+
+
+class MqttSink:
+    # Publishes each alert as JSON, retained so a new subscriber sees every rule's current state
+
+    def __init__(self, client, topic_root=ALERT_TOPIC_ROOT, qos=1):
+        self.client = client
+        self.topic_root = topic_root
+        self.qos = qos
+
+    def __call__(self, alert):
+        topic = "%s/%s/%s" % (self.topic_root, alert.device_id, alert.rule)
+        self.client.publish(topic, json.dumps(alert.to_dict()), qos=self.qos, retain=True)
+
+
+class AlertEngine:
+    """Evaluates alert rules on every stored sample, incrementally.
+
+    SensorDataReader calls process() with each sample's values in schema
+    field order. Rules are looked up per stream and keep their state per
+    device, so each sample costs O(1) per rule on its stream and streams
+    without rules cost one dict lookup. Sinks are callables taking an
+    Alert, called on the ingest thread when a rule fires or resolves; a
+    failing sink is reported and counted, it never stops ingest. Samples
+    older than the last one of their device and stream, e.g. replayed ones,
+    are skipped and counted, rule windows and sustain times assume time only
+    moves forward.
+    """
+
+    def __init__(self, rules, sinks=(), schemas=SCHEMAS):
+        self.rules = {}
+        for rule in rules:
+            index = schemas[rule.stream].field_names.index(rule.field)
+            self.rules.setdefault(rule.stream, []).append((rule, index))
+        self.sinks = list(sinks)
+        self.states = {}
+        # (device id, stream) -> ts of the last sample processed
+        self.last_ts = {}
+        self.lock = threading.Lock()
+        # (rule name, FIRING / RESOLVED) -> number of alerts
+        self.counts = {}
+        self.sink_errors = 0
+        self.out_of_order = 0
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def process(self, device_id, stream, ts, values):
+        rules = self.rules.get(stream)
+        if rules is None:
+            return
+        alerts = []
+        key = (device_id, stream)
+        with self.lock:
+            last_ts = self.last_ts.get(key)
+            if last_ts is not None and ts < last_ts:
+                self.out_of_order += 1
+                return
+            self.last_ts[key] = ts
+            states = self.states.get(key)
+            if states is None:
+                states = self.states[key] = [RuleState() for _ in rules]
+            for (rule, index), state in zip(rules, states):
+                value = values[index]
+                if rule.transform is not None:
+                    value = rule.transform(value)
+                value = rule.measure(state, ts, value)
+                if value is None:
+                    continue
+                if rule.breached(value, state.active):
+                    if not state.active:
+                        if state.breached_since is None:
+                            state.breached_since = ts
+                        if ts - state.breached_since >= rule.sustain_secs:
+                            state.active = True
+                            alerts.append(Alert(rule.name, device_id, FIRING, ts, value))
+                else:
+                    state.breached_since = None
+                    if state.active:
+                        state.active = False
+                        alerts.append(Alert(rule.name, device_id, RESOLVED, ts, value))
+            for alert in alerts:
+                key = (alert.rule, alert.state)
+                self.counts[key] = self.counts.get(key, 0) + 1
+        for alert in alerts:
+            self.emit(alert)
+
+    def emit(self, alert):
+        for sink in self.sinks:
+            try:
+                sink(alert)
+            except Exception:
+                self.sink_errors += 1
+                traceback.print_exc()
+
+    def active(self):
+        # (device id, rule name) of every alert currently firing
+        with self.lock:
+            return sorted((device_id, rule.name) for (device_id, stream), states in self.states.items()
+                          for (rule, _), state in zip(self.rules[stream], states) if state.active)
+
+
+def default_rules():
+    return [
+        Threshold("over_temperature", "basic", "temperature_c", above=OVER_TEMPERATURE_C, hysteresis=1.0,
+                  sustain_secs=10),
+        RateOfChange("pressure_drop", "basic", "pressure_millibars", PRESSURE_DROP_WINDOW_SECS,
+                     below=-PRESSURE_DROP_MILLIBARS, hysteresis=0.5),
+        Threshold("roll_tilt", "orientation", "roll", above=TILT_LIMIT_DEGREES, hysteresis=5.0, sustain_secs=1,
+                  transform=tilt_degrees),
+        Threshold("pitch_tilt", "orientation", "pitch", above=TILT_LIMIT_DEGREES, hysteresis=5.0, sustain_secs=1,
+                  transform=tilt_degrees),
+    ]
+
+
+if __name__ == '__main__':
+    # Alerting without a dashboard: logs every alert and optionally publishes them back to the broker
+    import sensor_capture
+    from sensor_data_mqtt_reader import SensorDataReader, DEFAULT_MQTT_SERVER
+
+    parser = argparse.ArgumentParser(description="Watch Sense Hat data for over-temperature, pressure drops and tilt")
+    parser.add_argument("--mq_server", default=DEFAULT_MQTT_SERVER)
+    parser.add_argument("--publish_alerts", action="store_true",
+                        help="Also publish alerts to " + ALERT_TOPIC_ROOT + "/<device>/<rule>")
+    sensor_capture.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    engine = AlertEngine(default_rules(), [LogSink()])
+    reader = SensorDataReader(mq_server=args.mq_server, alerts=engine)
+    sensor_capture.start_reader(reader, args)
+    if args.publish_alerts:
+        import paho.mqtt.client as mqtt
+        alert_client = mqtt.Client()
+        alert_client.connect(args.mq_server)
+        alert_client.loop_start()
+        engine.add_sink(MqttSink(alert_client))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
@@ -0,0 +1,152 @@
+import argparse
+import struct
+import threading
+import time
+from collections import deque
+
+CAPTURE_MAGIC = b"SHCAP"
+CAPTURE_VERSION = 1
+FILE_HEADER = struct.Struct("<5sB")
+RECORD_HEADER = struct.Struct("<dHI")  # receive time, topic length, payload length
+MAX_SPEED = 0  # Replay speed meaning as fast as the handler keeps up
+DEFAULT_CAPTURE_QUEUE_LEN = 100000
+CAPTURE_FLUSH_SECS = 0.5
+
+
+class CaptureWriter:
+    """Appends raw (topic, payload, receive time) MQTT messages to a capture file.
+
+    Records are a fixed header followed by the topic and the payload exactly as
+    received, so JSON and binary payloads are replayed byte for byte. write()
+    only queues the message, so it is safe on paho's network thread; a writer
+    thread appends the queue to the file and flushes it every flush_secs, so a
+    crash loses at most that much. Messages arriving while queue_len are
+    waiting are dropped and counted.
+    """
+
+    def __init__(self, path, queue_len=DEFAULT_CAPTURE_QUEUE_LEN, flush_secs=CAPTURE_FLUSH_SECS):
+        self.path = path
+        self.queue_len = queue_len
+        self.flush_secs = flush_secs
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+        # deque append/popleft are atomic, the network thread never waits on the disk
+        self.queue = deque()
+        self.records = 0
+        self.dropped = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._write_loop, name="sensor-capture", daemon=True)
+        self.thread.start()
+
+    def write(self, topic, payload, receive_time):
+        if self.stop_event.is_set():
+            return
+        if len(self.queue) >= self.queue_len:
+            self.dropped += 1
+            return
+        self.queue.append((topic, payload, receive_time))
+
+    def _write_loop(self):
+        while not self.stop_event.wait(self.flush_secs):
+            self._write_queued()
+        self._write_queued()
+        self.file.close()
+
+    def _write_queued(self):
+        while self.queue:
+            topic, payload, receive_time = self.queue.popleft()
+            topic = topic.encode("utf-8")
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            self.file.write(RECORD_HEADER.pack(receive_time, len(topic), len(payload)) + topic + payload)
+            self.records += 1
+        self.file.flush()
+
+    def close(self):
+        # Writes and closes whatever is still queued
+        self.stop_event.set()
+        self.thread.join()
+
+
+def read_capture(path):
+    # Yields (topic, payload, receive_time) in capture order
+    with open(path, "rb") as f:
+        magic, version = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError("Not a version %d sensor capture file: %s" % (CAPTURE_VERSION, path))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            receive_time, topic_len, payload_len = RECORD_HEADER.unpack(header)
+            topic = f.read(topic_len).decode("utf-8")
+            payload = f.read(payload_len)
+            if len(payload) < payload_len:
+                # Capture cut short while being written
+                return
+            yield topic, payload, receive_time
+
+
+def replay(path, handler, speed=1.0, stop_event=None):
+    """Calls handler(topic, payload, receive_time) for every captured message.
+
+    Messages keep their original spacing divided by speed, MAX_SPEED sends
+    them back to back. receive_time is passed as None: the payloads keep
+    their original ts, so an end to end latency against the replay time
+    would only measure the capture's age. Returns the number of messages
+    replayed.
+    """
+    start = time.monotonic()
+    first = None
+    replayed = 0
+    for topic, payload, receive_time in read_capture(path):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if speed > 0:
+            if first is None:
+                first = receive_time
+            wait = (receive_time - first) / speed - (time.monotonic() - start)
+            if wait > 0:
+                time.sleep(wait)
+        handler(topic, payload, None)
+        replayed += 1
+    return replayed
+
+
+def add_arguments(parser):
+    # --capture / --replay options shared by the dashboards
+    parser.add_argument("--capture", default=None, help="Record every received MQTT message to this capture file")
+    parser.add_argument("--replay", default=None, help="Replay this capture file instead of connecting to MQTT")
+    parser.add_argument("--replay_speed", type=float, default=1.0,
+                        help="Replay speed, 1 for real time, 10 for ten times faster, 0 for as fast as possible")
+
+
+def start_reader(reader, args):
+    # Starts the reader from MQTT, optionally capturing, or from the --replay capture file
+    if args.replay:
+        reader.start_replay(args.replay, args.replay_speed)
+        return
+    if args.capture:
+        reader.start_capture(args.capture)
+    reader.init_and_start_mqtt()
+
+
+if __name__ == '__main__':
+    # Offline ingest profiling: replay a capture into a SensorDataReader without hardware or a broker
+    from sensor_data_mqtt_reader import SensorDataReader
+
+    parser = argparse.ArgumentParser(description="Replay a sensor capture file into a SensorDataReader")
+    parser.add_argument("capture", help="Capture file written by SensorDataReader.start_capture")
+    parser.add_argument("--speed", type=float, default=MAX_SPEED,
+                        help="Replay speed, 1 for real time, 10 for ten times faster, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    reader = SensorDataReader()
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    replayed = replay(args.capture, reader.store_live_data, args.speed)
+    elapsed = time.monotonic() - start
+    cpu_secs = time.process_time() - cpu_start
+    reader.close()
+    print("Replayed %d messages in %.3f s, %.0f messages/s, %.1f us CPU per message" % (
+        replayed, elapsed, replayed / elapsed if elapsed > 0 else 0, cpu_secs / replayed * 1e6 if replayed else 0))
@@ -1,89 +1,369 @@
+import threading
+import time
 import traceback
-from collections import deque
 from datetime import datetime as dt
+from urllib.parse import quote
 
-import json
+import numpy as np
 import paho.mqtt.client as mqtt
+from sensor_ring_buffer import ColumnarRingBuffer
+import sensor_ingest_pipeline
+from sensor_history_store import SensorHistoryStore
+from sensor_rollups import MultiResolutionRollup
+from sensor_schema_registry import SCHEMAS
+from SenseHatCode.sensor_payload_codec import valid_device_id
+import sensor_capture
+import sensor_metrics
 
 DEFAULT_MQTT_SERVER = "pi-fw.local"
 DEFAULT_QUEUE_LEN = 10
 DEFAULT_TOPIC = "sense_hat/#"
 DEAFULT_NO_OF_DECIMALS = 3
 
+# Topics are sense_hat/<device id>/data/<sensor>, publishers without a device id use
+# sense_hat/data/<sensor> and land in DEFAULT_DEVICE
+TOPIC_ROOT = "sense_hat"
+TOPIC_DATA = "data"
+DEFAULT_DEVICE = "default"
+# Metric label for every topic outside the sense_hat data tree, so strangers can not grow the label sets
+UNKNOWN_TOPIC_LABEL = "unknown"
+
+SIMPLE_DATA_FIELDS = SCHEMAS["basic"].field_names
+ANGLE_FIELDS = SCHEMAS["orientation"].field_names
+
+
+def local_buffer(device_id, stream, fields, capacity):
+    return ColumnarRingBuffer(fields, capacity)
+
+
+class SensorDevice:
+    # Buffers and rollups of one Sense HAT, every device gets its own set
+
+    def __init__(self, device_id, queue_len, buffer_factory=local_buffer, join=None, rollups=True):
+        # buffer_factory(device_id, stream, fields, capacity) makes each stream's ColumnarRingBuffer
+        self.device_id = device_id
+        self.simple_data_q = buffer_factory(device_id, "basic", SIMPLE_DATA_FIELDS, queue_len)
+        self.accel_data_q = buffer_factory(device_id, "accel", ANGLE_FIELDS, queue_len)
+        self.gyro_data_q = buffer_factory(device_id, "gyro", ANGLE_FIELDS, queue_len)
+        self.ori_data_q = buffer_factory(device_id, "orientation", ANGLE_FIELDS, queue_len)
+        self.streams = {
+            "basic": self.simple_data_q,
+            "accel": self.accel_data_q,
+            "gyro": self.gyro_data_q,
+            "orientation": self.ori_data_q
+        }
+        # Rows of a sensor_stream_join.StreamJoin, a stream like the others under the join's name
+        self.joined_q = None
+        if join is not None:
+            self.joined_q = buffer_factory(device_id, join.name, join.fields, queue_len)
+            self.streams[join.name] = self.joined_q
+        # 1 s / 1 min / 1 h aggregates kept up to date per sample for trend views, only where samples are stored
+        self.rollups = {stream: MultiResolutionRollup(schema.rollup_fields)
+                        for stream, schema in SCHEMAS.items() if schema.rollup_fields} if rollups else {}
+
+    def history_name(self, stream):
+        # The default device keeps the plain stream names used before devices existed
+        if self.device_id == DEFAULT_DEVICE:
+            return stream
+        # Quoted so the id is always one plain directory name under the history root
+        return quote(self.device_id, safe="") + "/" + stream
+
+
+def device_shard_key(topic):
+    # sense_hat/<device id>/data, shared by every stream of a device
+    return topic.rpartition("/")[0]
+
+
 class SensorDataReader:
+    # Readers that store samples keep rollups of them, attached readers leave that to the ingest process
+    keep_rollups = True
 
     def __init__(self, mq_server=DEFAULT_MQTT_SERVER, queue_len=DEFAULT_QUEUE_LEN,
                  timestamp_format="%d/%m/%Y, %H:%M:%S.%f",
-                 no_of_deimals=DEAFULT_NO_OF_DECIMALS,topic=DEFAULT_TOPIC):
+                 no_of_deimals=DEAFULT_NO_OF_DECIMALS,topic=DEFAULT_TOPIC,
+                 ingest_queue_len=sensor_ingest_pipeline.DEFAULT_INGEST_QUEUE_LEN,
+                 overflow_policy=sensor_ingest_pipeline.DROP_OLDEST, ingest_workers=1,
+                 history_dir=None, history_retention_secs=None, metrics=None, buffer_factory=local_buffer,
+                 alerts=None, join=None):
         self.mq_server = mq_server
         self.queue_len = queue_len
         self.no_of_decimals = no_of_deimals
         self.timestamp_format = timestamp_format
-        self.simple_data_q = deque(maxlen=queue_len)
-        self.accel_data_q = deque(maxlen=queue_len)
-        self.gyro_data_q = deque(maxlen=queue_len)
-        self.ori_data_q = deque(maxlen=queue_len)
+        self.devices = {}
+        self.devices_lock = threading.Lock()
+        self.buffer_factory = buffer_factory
+        # Optional sensor_stream_join.StreamJoin, its rows are stored as one more stream per device
+        self.join = join
+        # Optional on disk copy of every stream that outlives the ring buffers and restarts
+        self.history = None
+        if history_dir is not None:
+            self.open_history(history_dir, history_retention_secs)
+        self.default_device = self.add_device(DEFAULT_DEVICE)
+        # The default device's buffers stay reachable under their original names
+        self.simple_data_q = self.default_device.simple_data_q
+        self.accel_data_q = self.default_device.accel_data_q
+        self.gyro_data_q = self.default_device.gyro_data_q
+        self.ori_data_q = self.default_device.ori_data_q
+        self.streams = self.default_device.streams
+        self.rollups = self.default_device.rollups
         self.topic = topic
-        self.topic_to_f_mapping = {
-            "sense_hat/data/basic": self.store_simple_data,
-            "sense_hat/data/accel": self.store_accel_data,
-            "sense_hat/data/gyro": self.store_gyro_data,
-            "sense_hat/data/orientation": self.store_orientation_data
-        }
+        # Topic suffix -> TopicSchema, each with a decoder generated for its fields
+        self.schemas = SCHEMAS
+        self.topic_routes = {}
+        self.init_ingest(ingest_queue_len, overflow_policy, ingest_workers)
+        self.capture = None
+        self.mqtt_client = None
+        # Optional sensor_alerts.AlertEngine, sees every stored sample
+        self.alerts = alerts
+        # Notified after every stored message, lets push endpoints sleep until there is something to send
+        self.data_changed = threading.Condition()
+        self.metrics = metrics if metrics is not None else sensor_metrics.MetricsRegistry()
+        self.init_metrics()
+
+    def init_ingest(self, queue_len, overflow_policy, workers):
+        # Decoding happens on the ingest workers so paho's network thread only enqueues. A join needs
+        # every stream of a device on one worker, else it sees them skewed by each worker's backlog
+        self.ingest = sensor_ingest_pipeline.IngestPipeline(
+            lambda topic, payload, receive_time: self.store_live_data(topic, payload, receive_time),
+            queue_len=queue_len, overflow_policy=overflow_policy, workers=workers,
+            shard_key=device_shard_key if self.join is not None else None)
+
+    def init_metrics(self):
+        self.messages_metric = self.metrics.counter("sensor_messages_total", "Messages received per topic",
+                                                    ("topic",))
+        self.message_bytes_metric = self.metrics.counter("sensor_message_bytes_total",
+                                                         "Payload bytes received per topic", ("topic",))
+        self.unknown_topic_metric = self.metrics.counter("sensor_unknown_topic_messages_total",
+                                                         "Messages on topics with no store function", ("topic",))
+        self.decode_metric = self.metrics.histogram("sensor_decode_seconds", "Payload decode time per message",
+                                                    sensor_metrics.DECODE_BUCKETS_SECS, ("topic",))
+        self.latency_metric = self.metrics.histogram("sensor_end_to_end_latency_seconds",
+                                                     "Time from the publisher's ts to receipt, per sample",
+                                                     sensor_metrics.LATENCY_BUCKETS_SECS, ("topic",))
+        self.init_buffer_metrics()
+        self.metrics.gauge("sensor_ingest_queue_depth", "Messages waiting for the decode workers", (),
+                           lambda: {(): len(self.ingest)})
+        self.metrics.counter("sensor_ingest_dropped_total", "Messages dropped by the ingest queue overflow policy",
+                             (), lambda: {(): self.ingest.dropped})
+        self.metrics.counter("sensor_ingest_failed_total", "Messages the decode workers failed to store", (),
+                             lambda: {(): self.ingest.failed})
+        self.metrics.counter("sensor_rollup_late_samples_total", "Samples older than the open rollup bucket, dropped",
+                             ("device", "stream", "bucket_secs"),
+                             lambda: {(d.device_id, stream, str(bucket_secs)): late
+                                      for d in list(self.devices.values()) for stream, rollup in d.rollups.items()
+                                      for bucket_secs, late in rollup.late_samples().items()})
+        if self.alerts is not None:
+            self.metrics.counter("sensor_alerts_total", "Alerts fired and resolved per rule", ("rule", "state"),
+                                 lambda: dict(self.alerts.counts))
+            self.metrics.counter("sensor_alerts_out_of_order_total",
+                                 "Samples older than the last one alerts saw, skipped", (), lambda: {(): self.alerts.out_of_order})
+
+    def init_buffer_metrics(self):
+        # Read when scraped, nothing is recorded on the ingest path
+        self.metrics.gauge("sensor_buffer_samples", "Samples held in each ring buffer", ("device", "stream"),
+                           lambda: {(d.device_id, name): len(b) for d in list(self.devices.values())
+                                    for name, b in d.streams.items()})
+        self.metrics.gauge("sensor_buffer_fill_ratio", "Ring buffer fill level", ("device", "stream"),
+                           lambda: {(d.device_id, name): len(b) / b.capacity for d in list(self.devices.values())
+                                    for name, b in d.streams.items()})
+
+    def device(self, device_id):
+        # Read paths: the device once data arrived for it, else an empty stand-in that is not kept,
+        # so ids coming from clients never allocate buffers or show up in device_ids
+        device = self.devices.get(device_id)
+        if device is None:
+            return self.empty_device(device_id)
+        return device
+
+    def has_device(self, device_id):
+        return device_id in self.devices
+
+    def empty_device(self, device_id):
+        return SensorDevice(device_id, 1, join=self.join, rollups=False)
+
+    def add_device(self, device_id):
+        # Only ingest (route) creates devices
+        device = self.devices.get(device_id)
+        if device is None:
+            with self.devices_lock:
+                device = self.devices.get(device_id)
+                if device is None:
+                    device = SensorDevice(device_id, self.queue_len, self.buffer_factory, self.join,
+                                          self.keep_rollups)
+                    if self.history is not None:
+                        for name, buffer in device.streams.items():
+                            self.history.get_series(device.history_name(name), buffer.fields)
+                    self.devices[device_id] = device
+        return device
+
+    def open_history(self, history_dir, retention_secs=None):
+        self.history = SensorHistoryStore(history_dir, retention_secs=retention_secs)
+        for device in list(self.devices.values()):
+            for name, buffer in device.streams.items():
+                self.history.get_series(device.history_name(name), buffer.fields)
+
+    def device_ids(self):
+        return sorted(self.devices)
+
+    def version(self, stream, device_id=DEFAULT_DEVICE):
+        return self.device(device_id).streams[stream].version
+
+    def snapshot(self, stream, device_id=DEFAULT_DEVICE):
+        # Immutable, consistent view of a stream, taken without holding up ingest
+        return self.device(device_id).streams[stream].snapshot()
+
+    def query_history(self, stream, t0, t1, device_id=DEFAULT_DEVICE):
+        if self.history is None:
+            raise ValueError("SensorDataReader was created without a history_dir")
+        return self.history.query(self.device(device_id).history_name(stream), t0, t1)
+
+    def query_rollup(self, stream, t0, t1, max_points, device_id=DEFAULT_DEVICE):
+        # Returns (bucket_secs, columns) from the finest rollup tier that fits max_points over t0..t1
+        device = self.device(device_id)
+        if stream not in device.rollups:
+            raise KeyError("No %s rollups for device %s" % (stream, device_id))
+        return device.rollups[stream].query(t0, t1, max_points)
 
     def format_timestamp(self, ts):
         return dt.fromtimestamp(ts).strftime(self.timestamp_format)
 
-    def round_data_points(self, data_dict):
-        for k in filter(lambda x: x != "ts", data_dict.keys()):
-            data_dict[k] = round(data_dict[k], self.no_of_decimals)
-        return data_dict
-
-    def store_simple_data(self, data):
-        simple_data = json.loads(data)
-        simple_data["ts"] = self.format_timestamp(simple_data["ts"])
-        simple_data["humidity"] = simple_data["humidity"]
-        simple_data["temperature_c"] = simple_data["temperature_c"]
-        simple_data["pressure_millibars"] = simple_data["pressure_millibars"]
-        simple_data["compass_north"] = simple_data["compass_north"]
-
-        self.simple_data_q.append(self.round_data_points(simple_data))
-
-    def store_accel_data(self, data):
-        accel_data_dict = json.loads(data)
-        accel_data = {"ts": self.format_timestamp(accel_data_dict["ts"]),
-                      "roll": accel_data_dict["roll"],
-                      "yaw": accel_data_dict["yaw"],
-                      "pitch": accel_data_dict["pitch"],
-}
-        self.accel_data_q.append(self.round_data_points(accel_data))
-
-    def store_orientation_data(self, data):
-        orientation_data_dict = json.loads(data)
-        orientation_data = {"ts": self.format_timestamp(orientation_data_dict["ts"]),
-                            "roll": orientation_data_dict["roll"],
-                            "yaw": orientation_data_dict["yaw"],
-                            "pitch": orientation_data_dict["pitch"]}
-        self.ori_data_q.append(self.round_data_points(orientation_data))
-
-    def store_gyro_data(self, data):
-        gyro_data_dict = json.loads(data)
-        gyro_data = {"ts": self.format_timestamp(gyro_data_dict["ts"]), 
-                     "roll": gyro_data_dict["roll"],
-                     "yaw": gyro_data_dict["yaw"],
-                     "pitch": gyro_data_dict["pitch"],
-                     }
-        self.gyro_data_q.append(self.round_data_points(gyro_data))
-
-    def store_live_data(self, topic, data):
-        f = self.topic_to_f_mapping.get(topic)
-        if f != None:
-            f(data)
-        else:
-            None
-            # print("Unable to process data from topic " + topic)
-
-    def init_and_start_mqtt(self):
+    def display_precision(self, field, stream=None):
+        schema = self.schemas.get(stream)
+        precision = schema.precision.get(field) if schema is not None else None
+        return self.no_of_decimals if precision is None else precision
+
+    def to_datetimes(self, ts):
+        # Epoch seconds column to local time datetime64 values that plotly can use as an x axis
+        utc_offset = dt.now().astimezone().utcoffset().total_seconds()
+        return ((ts + utc_offset) * 1e6).astype("datetime64[us]")
+
+    def hold_last_value(self, columns, until_ts):
+        # Deadband publishers skip unchanged readings, so a gap means the last value still holds
+        ts = columns["ts"]
+        if len(ts) == 0 or ts[-1] >= until_ts:
+            return columns
+        return {name: np.append(values, until_ts if name == "ts" else values[-1]) for name, values in columns.items()}
+
+    def columns_to_records(self, columns, names, stream=None):
+        # Per sample dicts with formatted timestamps and rounded values, only built when rendering tables
+        rounded = [np.round(columns[name], self.display_precision(name, stream)).tolist() for name in names]
+        return [dict(zip(names, values), ts=self.format_timestamp(ts))
+                for ts, values in zip(columns["ts"].tolist(), zip(*rounded))]
+
+    def table_columns(self, stream, device_id=DEFAULT_DEVICE, window_secs=None):
+        # Rows a table pages over, the last window_secs of history when it is kept, else the ring buffer
+        if self.history is not None and window_secs:
+            now = time.time()
+            return self.query_history(stream, now - window_secs, now, device_id)
+        return self.snapshot(stream, device_id).columns()
+
+    def sort_order(self, columns, sort_by):
+        # Row order for a DataTable sort_by, [{"column_id": ..., "direction": "asc" | "desc"}, ...], None if unsorted
+        sort_by = [s for s in sort_by or [] if s["column_id"] in columns]
+        if not sort_by:
+            return None
+        if len(sort_by) == 1 and sort_by[0]["column_id"] == "ts":
+            # Already in time order
+            order = np.arange(len(columns["ts"]))
+            return order[::-1] if sort_by[0]["direction"] == "desc" else order
+        # lexsort takes the primary key last
+        return np.lexsort([-columns[s["column_id"]] if s["direction"] == "desc" else columns[s["column_id"]]
+                           for s in reversed(sort_by)])
+
+    def query_page(self, stream, page, page_size, sort_by=None, device_id=DEFAULT_DEVICE, window_secs=None):
+        """Returns (records, total rows) for one page of a table, sorted and sliced here rather than in the browser.
+
+        Only the page_size rows shown are rounded, formatted and sent, so a
+        table can page through tens of thousands of rows of history.
+        """
+        columns = self.table_columns(stream, device_id, window_secs)
+        total = len(columns["ts"])
+        start = page * page_size
+        order = self.sort_order(columns, sort_by)
+        rows = slice(start, start + page_size) if order is None else order[start:start + page_size]
+        fields = [name for name in columns if name != "ts"]
+        return self.columns_to_records({name: values[rows] for name, values in columns.items()}, fields, stream), total
+
+    def store_sample(self, stream, ts, values, device=None):
+        device = device or self.default_device
+        buffer = device.streams[stream]
+        buffer.append(ts, values)
+        if self.history is not None:
+            self.history.append(device.history_name(stream), buffer.fields, ts, values)
+
+    def store_values(self, schema, ts, values, device):
+        # values in schema field order, as produced by schema.decode
+        self.store_sample(schema.stream, ts, values, device)
+        if schema.rollup_indices:
+            device.rollups[schema.stream].update(ts, [values[i] for i in schema.rollup_indices])
+        if self.alerts is not None:
+            self.alerts.process(device.device_id, schema.stream, ts, values)
+        if self.join is not None:
+            for row_ts, row in self.join.process(device.device_id, schema.stream, ts, values):
+                self.store_sample(self.join.name, row_ts, row, device)
+
+    def store_record(self, stream, record, device=None):
+        schema = self.schemas[stream]
+        self.store_values(schema, record["ts"], [record[f] for f in schema.field_names], device or self.default_device)
+
+    def store_simple_data(self, simple_data, device=None):
+        self.store_record("basic", simple_data, device)
+
+    def store_accel_data(self, accel_data_dict, device=None):
+        self.store_record("accel", accel_data_dict, device)
+
+    def store_orientation_data(self, orientation_data_dict, device=None):
+        self.store_record("orientation", orientation_data_dict, device)
+
+    def store_gyro_data(self, gyro_data_dict, device=None):
+        self.store_record("gyro", gyro_data_dict, device)
+
+    def parse_topic(self, topic):
+        # Returns (device id, sensor) or None for topics outside the sense_hat data tree
+        parts = topic.split("/")
+        if len(parts) == 3 and parts[0] == TOPIC_ROOT and parts[1] == TOPIC_DATA:
+            return DEFAULT_DEVICE, parts[2]
+        if len(parts) == 4 and parts[0] == TOPIC_ROOT and parts[2] == TOPIC_DATA and valid_device_id(parts[1]):
+            return parts[1], parts[3]
+        return None
+
+    def route(self, topic):
+        # Topic -> (device, schema), cached since the set of valid topics is small. Misses are not, any
+        # client on the broker can make up topics
+        route = self.topic_routes.get(topic)
+        if route is None:
+            parsed = self.parse_topic(topic)
+            schema = self.schemas.get(parsed[1]) if parsed is not None else None
+            if schema is None:
+                return None, None
+            route = self.topic_routes[topic] = (self.add_device(parsed[0]), schema)
+        return route
+
+    def store_live_data(self, topic, data, receive_time=None):
+        device, schema = self.route(topic)
+        labels = (topic,) if schema is not None else (UNKNOWN_TOPIC_LABEL,)
+        self.messages_metric.inc(labels)
+        self.message_bytes_metric.inc(labels, len(data))
+        if schema is None:
+            self.unknown_topic_metric.inc(labels)
+            return
+        start = time.perf_counter()
+        samples = schema.decode(data)
+        self.decode_metric.observe(time.perf_counter() - start, labels)
+        for ts, values in samples:
+            if receive_time is not None:
+                self.latency_metric.observe(receive_time - ts, labels)
+            self.store_values(schema, ts, values, device)
+        with self.data_changed:
+            self.data_changed.notify_all()
+
+    def wait_for_data(self, predicate, timeout=None):
+        # Blocks until predicate() is true, re-checked after each stored message, returns its last value
+        with self.data_changed:
+            return self.data_changed.wait_for(predicate, timeout)
+
+    def init_and_start_mqtt(self, client=None):
+        # client defaults to a paho client for mq_server, any object with the same interface can be passed in
         def on_connect(client, userdata, flags, rc):
             print("Connected...")
             print("Subcribing to " + self.topic)
@@ -93,11 +373,51 @@ class SensorDataReader:
             print("Disconnected...")
 
         def on_message(client, userdata, msg):
-            self.store_live_data(msg.topic, msg.payload)
+            receive_time = time.time()
+            capture = self.capture
+            if capture is not None:
+                # Only queued, the capture's own thread does the file I/O
+                capture.write(msg.topic, msg.payload, receive_time)
+            self.ingest.submit(msg.topic, msg.payload, receive_time)
 
-        client = mqtt.Client()
+        if client is None:
+            client = mqtt.Client()
         client.on_connect = on_connect
         client.on_message = on_message
         client.on_disconnect = on_disconnect
-        client.connect(DEFAULT_MQTT_SERVER)
+        self.ingest.start()
+        client.connect(self.mq_server)
         client.loop_start()
+        self.mqtt_client = client
+        return client
+
+    def close(self):
+        # Stops reading MQTT, stores what the ingest workers still hold, then flushes and closes capture and history
+        client, self.mqtt_client = self.mqtt_client, None
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+        if self.ingest is not None:
+            self.ingest.stop()
+        self.stop_capture()
+        if self.history is not None:
+            self.history.close()
+
+    def start_capture(self, path):
+        # Records every message received from MQTT, raw, for replay_capture
+        self.stop_capture()
+        self.capture = sensor_capture.CaptureWriter(path)
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def replay_capture(self, path, speed=1.0, stop_event=None):
+        # Feeds a capture into store_live_data as if it arrived now, speed 0 replays as fast as possible
+        return sensor_capture.replay(path, self.store_live_data, speed, stop_event)
+
+    def start_replay(self, path, speed=1.0):
+        thread = threading.Thread(target=self.replay_capture, args=(path, speed), name="sensor-replay", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,86 @@
+import json
+import time
+
+import flask
+import numpy as np
+
+STREAM_PATH = "/stream"
+KEEPALIVE_SECS = 15
+RECONNECT_MS = 2000
+# Samples arriving closer together than this go out as one event
+MIN_EVENT_INTERVAL_SECS = 0.02
+# While the push stream is open the pushed graphs' own interval only polls for full figures (downsampling)
+PUSH_POLL_INTERVAL_MS = 10 * 1000
+# After a push stream fails the graphs poll for this long before the browser tries the stream again
+PUSH_RETRY_MS = 60 * 1000
+
+
+def install_event_stream(app, reader, min_event_interval_secs=MIN_EVENT_INTERVAL_SECS):
+    """Mounts a Server-Sent Events endpoint STREAM_PATH/<device_id>/<stream> on the Dash app's Flask server.
+
+    Each event carries every sample of the stream after the client's position
+    as {"seq": next seq, "ts": [...], <field>: [...]}, the event id is the seq so
+    a reconnecting EventSource resumes where it left off (Last-Event-ID). The
+    request thread sleeps on the reader's data_changed condition between
+    events, so an idle client costs a keepalive comment every KEEPALIVE_SECS.
+
+    Every open stream holds its worker thread for as long as the page is
+    open. Serve the app with threads or an async worker class, e.g. gunicorn
+    --worker-class gthread --threads 32 or --worker-class gevent; sync workers
+    have one request each and kill it after their timeout. Pages share one
+    stream per device and stream between all their graphs.
+    """
+
+    @app.server.route(STREAM_PATH + "/<device_id>/<stream>")
+    def sensor_event_stream(device_id, stream):
+        # Unknown devices are a 404 rather than an empty stream, EventSource gives up and the page polls instead
+        if not reader.has_device(device_id):
+            flask.abort(404)
+        device = reader.device(device_id)
+        if stream not in device.streams:
+            flask.abort(404)
+        buffer = device.streams[stream]
+        seq = flask.request.headers.get("Last-Event-ID") or flask.request.args.get("seq")
+        try:
+            seq = buffer.count if seq is None else int(seq)
+        except ValueError:
+            flask.abort(400)
+
+        def events():
+            nonlocal seq
+            # Sent straight away so the response starts, and sets the browser's reconnect delay
+            yield "retry: %d\n\n" % RECONNECT_MS
+            while True:
+                if not reader.wait_for_data(lambda: buffer.count != seq, KEEPALIVE_SECS):
+                    yield ": keepalive\n\n"
+                    continue
+                start_seq, columns = buffer.consistent_since(seq)
+                seq = start_seq + len(columns["ts"])
+                event = {name: values.tolist() for name, values in columns.items() if name != "ts"}
+                event["ts"] = np.datetime_as_string(reader.to_datetimes(columns["ts"])).tolist()
+                event["seq"] = seq
+                yield "id: %d\ndata: %s\n\n" % (seq, json.dumps(event))
+                time.sleep(min_event_interval_secs)
+
+        return flask.Response(events(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def stream_subscriber(graph_id, state_id, stream, traces, max_points, interval_id=None, interval_ms=1000):
+    """Clientside callback code appending pushed samples of stream to graph_id.
+
+    traces maps a trace property to the field each trace takes it from, e.g.
+    {"x": ["ts", "ts"], "y": ["yaw", "roll"]}. Use it with
+    Input(state_id, "data") and State("device-select", "value"); the
+    subscription restarts whenever the server sends a full figure. Graphs
+    on the same device and stream share one EventSource.
+    interval_id, slowed to PUSH_POLL_INTERVAL_MS once the stream is open,
+    should be an interval that only drives the pushed graphs; interval_ms is
+    its own interval, restored when the stream fails and the graphs go back
+    to polling for PUSH_RETRY_MS.
+    """
+    config = {"graph_id": graph_id, "state_id": state_id, "stream": stream, "traces": traces,
+              "max_points": max_points, "interval_id": interval_id, "interval_ms": interval_ms,
+              "poll_interval_ms": PUSH_POLL_INTERVAL_MS, "retry_ms": PUSH_RETRY_MS, "path": STREAM_PATH}
+    return "function(state, deviceId) { return window.sensorEventStream.subscribe(state, deviceId, %s); }" % (
+        json.dumps(config))
@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_SEGMENT_SECS = 3600
+DEFAULT_FLUSH_RECORDS = 1000
+DEFAULT_FLUSH_SECS = 1.0
+ACTIVE_SEGMENT = "active.seg"
+SCHEMA_FILE = "schema.json"
+SEGMENT_SUFFIX = ".seg"
+
+
+def segment_name(start_ts, end_ts):
+    # Zero padded so a plain sort of the names is a sort by start time
+    return "%017.6f_%017.6f%s" % (start_ts, end_ts, SEGMENT_SUFFIX)
+
+
+def parse_segment_name(name):
+    start, end = name[:-len(SEGMENT_SUFFIX)].split("_")
+    return float(start), float(end)
+
+
+class HistorySeries:
+    """One append-only, time segmented series of fixed size float64 records.
+
+    Records are (ts, field...) rows. Samples are buffered in memory and
+    appended to the active segment every flush_records samples or flush_secs
+    seconds. Once the active segment spans segment_secs it is closed and
+    renamed to <min ts>_<max ts>.seg, so the file names alone form the time
+    index. Range queries only open the segments overlapping the requested
+    window, memory map them and binary search the ts column.
+
+    Samples do arrive out of order (spool replays, several ingest workers).
+    Each flush is sorted, the active segment remembers whether it is still in
+    order and is sorted once when it closes, so closed segments can always be
+    binary searched; only an out of order active segment is scanned.
+    """
+
+    def __init__(self, path, fields, segment_secs=DEFAULT_SEGMENT_SECS, flush_records=DEFAULT_FLUSH_RECORDS,
+                 flush_secs=DEFAULT_FLUSH_SECS, retention_secs=None):
+        self.path = path
+        self.fields = tuple(fields)
+        self.dtype = np.dtype([(name, "<f8") for name in ("ts",) + self.fields])
+        self.segment_secs = segment_secs
+        self.flush_records = flush_records
+        self.flush_secs = flush_secs
+        self.retention_secs = retention_secs
+        self.lock = threading.Lock()
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.active_file = None
+        self.active_start = None
+        self.active_end = None
+        self.active_records = 0
+        self.active_sorted = True
+        os.makedirs(path, exist_ok=True)
+        self._check_schema()
+        self.segments = self._load_index()
+        self._close_leftover_active_segment()
+
+    def _check_schema(self):
+        schema_path = os.path.join(self.path, SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                stored_fields = tuple(json.load(f)["fields"])
+            if stored_fields != self.fields:
+                raise ValueError("History at %s has fields %s, expected %s" % (self.path, stored_fields, self.fields))
+        else:
+            with open(schema_path, "w") as f:
+                json.dump({"fields": list(self.fields)}, f)
+
+    def _load_index(self):
+        segments = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(SEGMENT_SUFFIX) and name != ACTIVE_SEGMENT:
+                start, end = parse_segment_name(name)
+                segments.append((start, end, os.path.join(self.path, name)))
+        return segments
+
+    def _close_leftover_active_segment(self):
+        # An active segment left behind by a previous run is closed as is
+        active_path = os.path.join(self.path, ACTIVE_SEGMENT)
+        if not os.path.exists(active_path):
+            return
+        records = np.fromfile(active_path, dtype=self.dtype)
+        if len(records) == 0:
+            os.remove(active_path)
+            return
+        ts = records["ts"]
+        self.active_start = float(ts.min())
+        self.active_end = float(ts.max())
+        self.active_sorted = bool(np.all(ts[1:] >= ts[:-1]))
+        self._close_active_segment()
+
+    def append(self, ts, values):
+        with self.lock:
+            self.pending.append((ts,) + tuple(values))
+            if len(self.pending) >= self.flush_records or time.monotonic() - self.last_flush >= self.flush_secs:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        records = np.array(self.pending, dtype=self.dtype)
+        records = records[np.argsort(records["ts"], kind="stable")]
+        self.pending = []
+        first, last = float(records["ts"][0]), float(records["ts"][-1])
+        if self.active_file is None:
+            self.active_file = open(os.path.join(self.path, ACTIVE_SEGMENT), "ab")
+            self.active_start, self.active_end = first, last
+            self.active_records = 0
+            self.active_sorted = True
+        elif first < self.active_end:
+            self.active_sorted = False
+        self.active_file.write(records.tobytes())
+        self.active_file.flush()
+        self.active_records += len(records)
+        self.active_start = min(self.active_start, first)
+        self.active_end = max(self.active_end, last)
+        if self.active_end - self.active_start >= self.segment_secs:
+            self._close_active_segment()
+
+    def _close_active_segment(self):
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+        path = os.path.join(self.path, segment_name(self.active_start, self.active_end))
+        active_path = os.path.join(self.path, ACTIVE_SEGMENT)
+        if self.active_sorted:
+            os.replace(active_path, path)
+        else:
+            # Written to a new file, queries may still have the old one mapped
+            records = np.fromfile(active_path, dtype=self.dtype)
+            records[np.argsort(records["ts"], kind="stable")].tofile(path)
+            os.remove(active_path)
+        self.active_records = 0
+        self.active_sorted = True
+        self.segments.append((self.active_start, self.active_end, path))
+        self.active_start = self.active_end = None
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.retention_secs is None or not self.segments:
+            return
+        cutoff = self.segments[-1][1] - self.retention_secs
+        while self.segments and self.segments[0][1] < cutoff:
+            os.remove(self.segments.pop(0)[2])
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.active_file is not None:
+                self._close_active_segment()
+
+    def query(self, t0, t1):
+        """Returns {"ts": ..., field: ...} arrays for samples with t0 <= ts <= t1."""
+        with self.lock:
+            # Mapped under the lock: a mapping stays valid when the file is renamed, rewritten or removed later
+            mapped = [(np.memmap(path, dtype=self.dtype, mode="r"), True)
+                      for start, end, path in self.segments if end >= t0 and start <= t1]
+            if (self.active_file is not None and self.active_records
+                    and self.active_end >= t0 and self.active_start <= t1):
+                # Only the part flushed so far, the file keeps growing
+                mapped.append((np.memmap(os.path.join(self.path, ACTIVE_SEGMENT), dtype=self.dtype, mode="r",
+                                         shape=(self.active_records,)), self.active_sorted))
+            pending = np.array(self.pending, dtype=self.dtype)
+
+        parts = [self._slice(records, t0, t1, is_sorted) for records, is_sorted in mapped]
+        parts.append(self._slice(pending, t0, t1, False))
+        records = np.concatenate(parts)
+        ts = records["ts"]
+        if len(ts) > 1 and not np.all(ts[1:] >= ts[:-1]):
+            records = records[np.argsort(ts, kind="stable")]
+        return {name: np.ascontiguousarray(records[name]) for name in self.dtype.names}
+
+    @staticmethod
+    def _slice(records, t0, t1, is_sorted=True):
+        ts = records["ts"]
+        if not is_sorted:
+            return records[(ts >= t0) & (ts <= t1)]
+        return records[np.searchsorted(ts, t0, side="left"):np.searchsorted(ts, t1, side="right")]
+
+
+class SensorHistoryStore:
+    """Directory of HistorySeries, one sub directory per stream."""
+
+    def __init__(self, root, segment_secs=DEFAULT_SEGMENT_SECS, flush_records=DEFAULT_FLUSH_RECORDS,
+                 flush_secs=DEFAULT_FLUSH_SECS, retention_secs=None):
+        self.root = root
+        self.series_options = dict(segment_secs=segment_secs, flush_records=flush_records, flush_secs=flush_secs,
+                                   retention_secs=retention_secs)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def get_series(self, name, fields):
+        series = self.series.get(name)
+        if series is None:
+            with self.lock:
+                series = self.series.get(name)
+                if series is None:
+                    path = os.path.join(self.root, name)
+                    root = os.path.abspath(self.root)
+                    if os.path.commonpath([root, os.path.abspath(path)]) != root or os.path.abspath(path) == root:
+                        raise ValueError("History series name %r leaves the history directory" % name)
+                    series = HistorySeries(path, fields, **self.series_options)
+                    self.series[name] = series
+        return series
+
+    def append(self, name, fields, ts, values):
+        self.get_series(name, fields).append(ts, values)
+
+    def query(self, name, t0, t1):
+        series = self.series.get(name)
+        if series is None:
+            raise KeyError("No history for " + name)
+        return series.query(t0, t1)
+
+    def flush(self):
+        for series in list(self.series.values()):
+            series.flush()
+
+    def close(self):
+        for series in list(self.series.values()):
+            series.close()
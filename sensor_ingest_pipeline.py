@@ -0,0 +1,163 @@
+import threading
+import time
+import traceback
+from collections import deque
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+DEFAULT_INGEST_QUEUE_LEN = 10000
+DEFAULT_INGEST_BATCH_SIZE = 256
+
+
+class IngestQueue:
+    """Bounded queue between the MQTT network thread and the decode workers.
+
+    When full, DROP_OLDEST discards the oldest queued message, DROP_NEWEST
+    discards the incoming one and BLOCK waits (up to block_timeout seconds,
+    forever if None) for room, pushing back on the caller.
+    """
+
+    def __init__(self, maxlen=DEFAULT_INGEST_QUEUE_LEN, overflow_policy=DROP_OLDEST, block_timeout=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy " + str(overflow_policy))
+        self.maxlen = maxlen
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+        self.enqueued = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.high_watermark = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def dropped(self):
+        return self.dropped_oldest + self.dropped_newest
+
+    def put(self, item):
+        with self.lock:
+            if len(self.items) >= self.maxlen:
+                if self.overflow_policy == DROP_NEWEST:
+                    self.dropped_newest += 1
+                    return False
+                if self.overflow_policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped_oldest += 1
+                elif not self.not_full.wait_for(lambda: len(self.items) < self.maxlen or self.closed,
+                                                self.block_timeout) or self.closed:
+                    self.dropped_newest += 1
+                    return False
+            self.items.append(item)
+            self.enqueued += 1
+            self.high_watermark = max(self.high_watermark, len(self.items))
+            self.not_empty.notify()
+            return True
+
+    def get_batch(self, max_items, timeout=None):
+        with self.lock:
+            if not self.items and not self.closed:
+                self.not_empty.wait(timeout)
+            batch = []
+            while self.items and len(batch) < max_items:
+                batch.append(self.items.popleft())
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def stats(self):
+        return {
+            "depth": len(self.items),
+            "high_watermark": self.high_watermark,
+            "enqueued": self.enqueued,
+            "dropped_oldest": self.dropped_oldest,
+            "dropped_newest": self.dropped_newest
+        }
+
+
+class IngestPipeline:
+    """Decode workers draining IngestQueues of (topic, payload, receive_time) in batches.
+
+    Every worker has a queue of its own and each topic always goes to the
+    same one, so with several workers the samples of one stream are still
+    stored in the order they arrived. shard_key(topic) widens that to every
+    topic with the same key, e.g. all streams of one device. queue_len is
+    shared out between them.
+    """
+
+    def __init__(self, handler, queue_len=DEFAULT_INGEST_QUEUE_LEN, overflow_policy=DROP_OLDEST,
+                 workers=1, batch_size=DEFAULT_INGEST_BATCH_SIZE, block_timeout=None, shard_key=None):
+        self.handler = handler
+        self.shard_key = shard_key
+        workers = max(1, workers)
+        self.queues = [IngestQueue(max(1, queue_len // workers), overflow_policy, block_timeout)
+                       for _ in range(workers)]
+        self.no_of_workers = workers
+        self.batch_size = batch_size
+        self.threads = []
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, topic, payload, receive_time=None):
+        key = topic if self.shard_key is None else self.shard_key(topic)
+        queue = self.queues[hash(key) % self.no_of_workers]
+        return queue.put((topic, payload, time.time() if receive_time is None else receive_time))
+
+    def start(self):
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(queue,), name="sensor-ingest-%d" % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        for queue in self.queues:
+            queue.close()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _work(self, queue):
+        while True:
+            batch = queue.get_batch(self.batch_size, timeout=1.0)
+            if not batch:
+                if queue.closed:
+                    return
+                continue
+            for topic, payload, receive_time in batch:
+                try:
+                    self.handler(topic, payload, receive_time)
+                except Exception:
+                    self.failed += 1
+                    traceback.print_exc()
+            self.processed += len(batch)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    @property
+    def dropped(self):
+        return sum(queue.dropped for queue in self.queues)
+
+    def stats(self):
+        stats = {}
+        for queue in self.queues:
+            for name, value in queue.stats().items():
+                stats[name] = max(stats.get(name, 0), value) if name == "high_watermark" else \
+                    stats.get(name, 0) + value
+        stats["processed"] = self.processed
+        stats["failed"] = self.failed
+        return stats
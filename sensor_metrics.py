@@ -0,0 +1,179 @@
+import bisect
+import threading
+import time
+
+import flask
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+METRICS_PATH = "/metrics"
+DASH_UPDATE_PATH = "/_dash-update-component"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DECODE_BUCKETS_SECS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1)
+LATENCY_BUCKETS_SECS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RENDER_BUCKETS_SECS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+PAYLOAD_BUCKETS_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """One metric family, children are keyed by the tuple of label values.
+
+    Recording is a dict lookup and an add under a lock, so it is cheap enough
+    to leave on. Families created with a func are not recorded into at all,
+    func() returns {label values: value} when the registry is scraped.
+    """
+
+    def __init__(self, name, help, type, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labelvalues=(), amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def set(self, value, labelvalues=()):
+        self.values[labelvalues] = value
+
+    def lines(self):
+        values = self.func() if self.func is not None else dict(self.values)
+        return ["%s%s %s" % (self.name, _format_labels(self.labelnames, labels), _format_value(value))
+                for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        super().__init__(name, help, HISTOGRAM, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labelvalues=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            child = self.values.get(labelvalues)
+            if child is None:
+                # Per bucket (not cumulative) counts with a last slot for +Inf, then sum
+                child = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            child[0][i] += 1
+            child[1] += value
+
+    def time(self, labelvalues=()):
+        return _Timer(self, labelvalues)
+
+    def lines(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        lines = []
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for le, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    self.name, _format_labels(self.labelnames, labels, [("le", _format_value(le))]), cumulative))
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append("%s_sum%s %s" % (self.name, label_str, repr(total)))
+            lines.append("%s_count%s %d" % (self.name, label_str, cumulative))
+        return lines
+
+
+class _Timer:
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, self.labelvalues)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError("Metric " + metric.name + " is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=(), func=None):
+        return self._register(Metric(name, help, COUNTER, labelnames, func))
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        return self._register(Metric(name, help, GAUGE, labelnames, func))
+
+    def histogram(self, name, help, buckets, labelnames=()):
+        return self._register(Histogram(name, help, buckets, labelnames))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+
+def instrument_dash(app, registry):
+    """Mounts METRICS_PATH on the Dash app's Flask server and times every callback into registry.
+
+    Callback durations and response sizes are labelled with the callback's
+    output id, recorded from Flask request hooks so no callback needs changing.
+    """
+    render_seconds = registry.histogram("dash_callback_duration_seconds", "Dash callback request duration",
+                                        RENDER_BUCKETS_SECS, ("output",))
+    payload_bytes = registry.histogram("dash_callback_response_bytes", "Dash callback response size",
+                                       PAYLOAD_BUCKETS_BYTES, ("output",))
+    server = app.server
+
+    @server.before_request
+    def start_callback_timer():
+        if flask.request.path.endswith(DASH_UPDATE_PATH):
+            flask.g.callback_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        start = flask.g.pop("callback_start", None)
+        if start is not None:
+            body = flask.request.get_json(silent=True) or {}
+            output = (str(body.get("output", "")),)
+            render_seconds.observe(time.perf_counter() - start, output)
+            if not response.direct_passthrough:
+                payload_bytes.observe(len(response.get_data()), output)
+        return response
+
+    @server.route(METRICS_PATH)
+    def metrics():
+        return flask.Response(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
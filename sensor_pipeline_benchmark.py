@@ -0,0 +1,238 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+# The publisher modules import each other by bare name, as when run from SenseHatCode on the Pi
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "SenseHatCode"))
+
+import ReadAndPublishSensorData as publisher
+from publish_pipeline import PublishPipeline, JSON_ENCODING, BINARY_ENCODING, DEFAULT_MAX_INFLIGHT
+from sense_hat_simulator import SimulatedSenseHat
+from imu_window_aggregator import STATS_SUFFIX
+from sensor_data_mqtt_reader import SensorDataReader
+
+DEFAULT_DURATION_SECS = 10
+DEFAULT_IMU_RATE_HZ = 100
+IN_PROCESS_SERVER = "in-process"
+
+
+class FakeMessage:
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeMessageInfo:
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        self.published = False
+
+    def is_published(self):
+        return self.published
+
+
+class FakeMqttClient:
+    # The subset of paho's Client used by PublishPipeline and SensorDataReader, connected to a FakeBroker
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.next_mid = 0
+        self.mid_lock = threading.Lock()
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect(self, host, *args, **kwargs):
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    connect_async = connect
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(self, topic)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.mid_lock:
+            self.next_mid += 1
+            info = FakeMessageInfo(self.next_mid)
+        self.broker.publish(self, topic, payload, info)
+        return info
+
+
+class FakeBroker:
+    """In-process MQTT broker stand-in.
+
+    Messages are routed on a thread of their own, so like a real broker the
+    publisher's publish() returns before subscribers see the message, and
+    on_publish confirms it once it was delivered.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.messages = queue.Queue()
+        self.thread = None
+        self.delivered = 0
+        self.delivered_bytes = 0
+
+    def client(self):
+        return FakeMqttClient(self)
+
+    def subscribe(self, client, topic):
+        self.subscriptions.append((client, topic))
+
+    def publish(self, client, topic, payload, info):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.messages.put((client, topic, payload, info))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._route, name="fake-broker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Everything published before stop is still delivered
+        self.messages.put(None)
+        self.thread.join()
+
+    def _route(self):
+        while True:
+            message = self.messages.get()
+            if message is None:
+                return
+            publisher_client, topic, payload, info = message
+            for client, subscription in self.subscriptions:
+                if mqtt.topic_matches_sub(subscription, topic):
+                    client.on_message(client, None, FakeMessage(topic, payload))
+            self.delivered += 1
+            self.delivered_bytes += len(payload)
+            info.published = True
+            if publisher_client.on_publish is not None:
+                publisher_client.on_publish(publisher_client, None, info.mid)
+
+
+def record_store_latency(reader, latencies):
+    # Wraps the reader's store_sample to note how long after its "ts" each sample reached its buffer
+    store_sample = reader.store_sample
+
+    def store_and_time(stream, ts, values, device=None):
+        store_sample(stream, ts, values, device)
+        latencies.append(time.time() - ts)
+
+    reader.store_sample = store_and_time
+
+
+def run_benchmark(duration_secs, sensors, rates, encoding=JSON_ENCODING, batch_size=0, batch_ms=0,
+                  max_inflight=DEFAULT_MAX_INFLIGHT, ingest_workers=1, read_delay_secs=0.0, aggregate_window=0):
+    broker = FakeBroker()
+    reader = SensorDataReader(mq_server=IN_PROCESS_SERVER, ingest_workers=ingest_workers)
+    latencies = []
+    record_store_latency(reader, latencies)
+
+    broker.start()
+    reader.init_and_start_mqtt(broker.client())
+    connected = threading.Event()
+    connected.set()
+    aggregated = set(publisher.AGGREGATABLE_SENSORS).intersection(sensors) if aggregate_window > 0 else set()
+    topics = {s: publisher.sensor_topics[s] for s in sensors}
+    topics.update({s + STATS_SUFFIX: publisher.sensor_topics[s + STATS_SUFFIX] for s in aggregated})
+    pipeline = PublishPipeline(SimulatedSenseHat(seed=0, read_delay_secs=read_delay_secs), broker.client(), connected,
+                               {s: publisher.sensor_function_map[s][0] for s in sensors},
+                               topics,
+                               {s: rates[s] for s in sensors},
+                               encoding=encoding, batch_size=batch_size, batch_ms=batch_ms,
+                               batchable_sensors=publisher.BATCHABLE_SENSORS, max_inflight=max_inflight,
+                               aggregate_window=aggregate_window, aggregated_sensors=aggregated)
+
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    pipeline.start()
+    time.sleep(duration_secs)
+    pipeline.stop()
+    broker.stop()
+    reader.ingest.stop()
+    elapsed = time.monotonic() - start
+    cpu_secs = time.process_time() - cpu_start
+
+    latencies = np.array(latencies) * 1000
+    pipeline_stats = pipeline.stats()
+    ingest_stats = reader.ingest.stats()
+    return {
+        "elapsed_secs": elapsed,
+        "samples_read": pipeline_stats["sampled"],
+        "samples_dropped": pipeline_stats["dropped_samples"] + ingest_stats["dropped_oldest"] +
+                           ingest_stats["dropped_newest"],
+        "messages": broker.delivered,
+        "messages_per_sec": broker.delivered / elapsed,
+        "bytes_per_message": broker.delivered_bytes / broker.delivered if broker.delivered else 0.0,
+        "samples_stored": len(latencies),
+        "samples_per_sec": len(latencies) / elapsed,
+        "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else float("nan"),
+        "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else float("nan"),
+        "cpu_us_per_message": cpu_secs / broker.delivered * 1e6 if broker.delivered else float("nan"),
+        "cpu_utilisation": cpu_secs / elapsed,
+        "max_sample_queue_depth": pipeline_stats["max_queue_depth"],
+        "max_ingest_queue_depth": ingest_stats["high_watermark"]
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Publisher -> in-process broker -> SensorDataReader throughput and latency on a simulated Sense Hat")
+    parser.add_argument("-t", "--duration_secs", type=float, default=DEFAULT_DURATION_SECS)
+    parser.add_argument("-s", "--sensors", nargs='+', default=sorted(publisher.list_of_sensors),
+                        help="Sensors to publish " + str(publisher.list_of_sensors))
+    parser.add_argument("-r", "--sensor_rates", nargs='+', type=str, default=[],
+                        help="Per sensor read rate in Hz as <sensor>=<hz>, others run at --imu_rate_hz "
+                             "(basic_sensor at its default)")
+    parser.add_argument("--imu_rate_hz", type=float, default=DEFAULT_IMU_RATE_HZ)
+    parser.add_argument("-e", "--encoding", choices=[JSON_ENCODING, BINARY_ENCODING], default=JSON_ENCODING)
+    parser.add_argument("-b", "--batch_size", type=int, default=0)
+    parser.add_argument("--batch_ms", type=int, default=0)
+    parser.add_argument("--max_inflight", type=int, default=DEFAULT_MAX_INFLIGHT)
+    parser.add_argument("--ingest_workers", type=int, default=1)
+    parser.add_argument("--read_delay_ms", type=float, default=0.0,
+                        help="Simulated time each Sense Hat read takes")
+    parser.add_argument("--aggregate_window", type=int, default=0,
+                        help="Publish the raw IMU as statistics over windows of this many samples")
+    args = parser.parse_args()
+
+    invalid_sensors = set(args.sensors).difference(publisher.list_of_sensors)
+    if invalid_sensors:
+        parser.error("Invalid sensors " + str(invalid_sensors))
+    rates = {s: args.imu_rate_hz for s in publisher.list_of_sensors}
+    rates[publisher.SENSOR_BASIC] = publisher.DEFAULT_SENSOR_RATES_HZ[publisher.SENSOR_BASIC]
+    try:
+        rates.update(publisher.parse_sensor_rates(args.sensor_rates))
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    results = run_benchmark(args.duration_secs, args.sensors, rates, encoding=args.encoding,
+                            batch_size=args.batch_size, batch_ms=args.batch_ms, max_inflight=args.max_inflight,
+                            ingest_workers=args.ingest_workers, read_delay_secs=args.read_delay_ms / 1000,
+                            aggregate_window=args.aggregate_window)
+    for name, value in results.items():
+        print("%-24s %s" % (name, round(value, 3) if isinstance(value, float) else value))
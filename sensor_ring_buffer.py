@@ -0,0 +1,172 @@
+import threading
+
+import numpy as np
+
+
+class BufferSnapshot:
+    """Immutable copy of a ColumnarRingBuffer as it was at one version.
+
+    It answers the same reads as the buffer (len, columns, column, since,
+    latest) but never changes, so a callback can read it as often as it
+    likes and every trace it draws comes from the same moment.
+    """
+
+    def __init__(self, fields, first_seq, columns):
+        self.fields = fields
+        self.first_seq = first_seq
+        self.columns_data = columns
+        self.version = first_seq + len(columns["ts"])
+
+    def __len__(self):
+        return self.version - self.first_seq
+
+    def column(self, name, n=None):
+        return self.columns(n)[name]
+
+    def columns(self, n=None):
+        n = len(self) if n is None else min(n, len(self))
+        return self.since(self.version - n)[1]
+
+    def since(self, seq):
+        start = min(max(seq - self.first_seq, 0), len(self))
+        return self.first_seq + start, {name: values[start:] for name, values in self.columns_data.items()}
+
+    def snapshot(self):
+        return self
+
+    def latest(self):
+        if len(self) == 0:
+            return None
+        return {name: float(values[-1]) for name, values in self.columns_data.items()}
+
+
+class ColumnarRingBuffer:
+    """Fixed capacity circular buffer holding one float64 array per field plus "ts".
+
+    Every sample is written twice, at slot and slot + capacity, so the most
+    recent n samples are always one contiguous slice of each column. Reads
+    therefore return ordered NumPy views without copying or building per
+    sample objects.
+
+    since() returns live views that a later write can overwrite. Readers
+    needing a consistent picture use consistent_since() or snapshot(), which
+    work like a seqlock: writers announce how far they are about to write in
+    write_started before touching a slot, readers copy and then drop any
+    copied samples a writer may have been overwriting meanwhile. Neither side
+    waits for the other.
+    """
+
+    def __init__(self, fields, capacity):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.columns_data = {name: np.zeros(2 * capacity, dtype=np.float64) for name in ("ts",) + self.fields}
+        self.count = 0
+        # Sequence number one past the last sample a writer has started writing
+        self.write_started = 0
+        self._snapshot = None
+        # Serialises writers when several ingest workers feed the same stream, readers never take it
+        self.write_lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def version(self):
+        # Total number of samples ever written, grows by at least one on every change
+        return self.count
+
+    def append(self, ts, values):
+        with self.write_lock:
+            self.write_started = self.count + 1
+            slot = self.count % self.capacity
+            mirror = slot + self.capacity
+            ts_col = self.columns_data["ts"]
+            ts_col[slot] = ts_col[mirror] = ts
+            for name, value in zip(self.fields, values):
+                col = self.columns_data[name]
+                col[slot] = col[mirror] = value
+            self.count += 1
+
+    def extend(self, ts, columns):
+        ts = np.asarray(ts, dtype=np.float64)
+        n = len(ts)
+        if n == 0:
+            return
+        with self.write_lock:
+            self.write_started = self.count + n
+            if n > self.capacity:
+                ts = ts[-self.capacity:]
+                columns = {name: np.asarray(values)[-self.capacity:] for name, values in columns.items()}
+                self.count += n - self.capacity
+                n = self.capacity
+            slots = (self.count + np.arange(n)) % self.capacity
+            for name, values in [("ts", ts)] + [(name, columns[name]) for name in self.fields]:
+                col = self.columns_data[name]
+                col[slots] = values
+                col[slots + self.capacity] = values
+            self.count += n
+
+    def _window(self, start_seq, count=None):
+        # Returns the slice in the mirrored storage holding samples start_seq..count-1
+        count = self.count if count is None else count
+        start_seq = min(max(start_seq, count - self.capacity, 0), count)
+        start = start_seq % self.capacity
+        return start_seq, slice(start, start + count - start_seq)
+
+    def column(self, name, n=None):
+        return self.columns(n)[name]
+
+    def columns(self, n=None):
+        n = len(self) if n is None else min(n, len(self))
+        return self.since(self.count - n)[1]
+
+    def since(self, seq):
+        """Returns (first_seq, columns) for every retained sample with sequence number >= seq."""
+        start_seq, window = self._window(seq)
+        views = {}
+        for name, col in self.columns_data.items():
+            view = col[window]
+            view.flags.writeable = False
+            views[name] = view
+        return start_seq, views
+
+    def consistent_since(self, seq):
+        """Like since() but returns read-only copies no writer can touch.
+
+        Samples a concurrent write may have overwritten while they were being
+        copied are dropped from the front, so first_seq can be later than
+        asked for when a reader falls a whole buffer behind a writer.
+        """
+        count = self.count
+        start_seq, window = self._window(seq, count)
+        copies = {name: col[window].copy() for name, col in self.columns_data.items()}
+        # Writes that started during the copy reuse the slots of samples older than this
+        valid_from = self.write_started - self.capacity
+        if valid_from > start_seq:
+            drop = min(valid_from, count) - start_seq
+            copies = {name: values[drop:] for name, values in copies.items()}
+            start_seq += drop
+        for values in copies.values():
+            values.flags.writeable = False
+        return start_seq, copies
+
+    def snapshot(self):
+        """Returns a BufferSnapshot of every retained sample.
+
+        Snapshots are shared: callers asking at the same version get the same
+        object, so many callbacks reading an unchanged stream cost one copy.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != self.count:
+            start_seq, columns = self.consistent_since(0)
+            snapshot = BufferSnapshot(self.fields, start_seq, columns)
+            self._snapshot = snapshot
+        return snapshot
+
+    def latest(self):
+        start_seq, columns = self.consistent_since(self.count - 1)
+        if len(columns["ts"]) == 0:
+            return None
+        return {name: float(values[-1]) for name, values in columns.items()}
@@ -0,0 +1,106 @@
+import math
+import threading
+
+import numpy as np
+
+from sensor_ring_buffer import ColumnarRingBuffer
+
+# (bucket seconds, buckets retained): 1 s for an hour, 1 min for a week, 1 h for a year
+DEFAULT_ROLLUP_TIERS = ((1, 3600), (60, 7 * 24 * 60), (3600, 365 * 24))
+ROLLUP_STATS = ("min", "max", "mean", "last")
+
+
+class RollupTier:
+    """count/min/max/mean/last per field over fixed time buckets of bucket_secs.
+
+    The open bucket is kept as plain Python lists and updated in O(1) per
+    sample; when a sample lands in a later bucket the open one is closed into
+    a ColumnarRingBuffer (ts = bucket start). Samples older than the open
+    bucket are dropped and counted in late, closed buckets are never reopened
+    and folding them into the open one would stretch it over the wrong time.
+    """
+
+    def __init__(self, fields, bucket_secs, capacity):
+        self.fields = tuple(fields)
+        self.bucket_secs = bucket_secs
+        self.closed = ColumnarRingBuffer(
+            ("count",) + tuple("%s_%s" % (f, stat) for f in self.fields for stat in ROLLUP_STATS), capacity)
+        self.bucket = None
+        self.count = 0
+        self.late = 0
+        self.mins = self.maxs = self.sums = self.lasts = None
+
+    @property
+    def retention_secs(self):
+        return self.bucket_secs * self.closed.capacity
+
+    def update(self, ts, values):
+        bucket = math.floor(ts / self.bucket_secs)
+        if self.bucket is None or bucket > self.bucket:
+            if self.bucket is not None:
+                self.closed.append(self.bucket * self.bucket_secs, self._open_bucket_row())
+            self.bucket = bucket
+            self.count = 1
+            self.mins = list(values)
+            self.maxs = list(values)
+            self.sums = list(values)
+            self.lasts = list(values)
+            return
+        if bucket < self.bucket:
+            self.late += 1
+            return
+        self.count += 1
+        for i, value in enumerate(values):
+            if value < self.mins[i]:
+                self.mins[i] = value
+            if value > self.maxs[i]:
+                self.maxs[i] = value
+            self.sums[i] += value
+            self.lasts[i] = value
+
+    def _open_bucket_row(self):
+        row = [self.count]
+        for i in range(len(self.fields)):
+            row += [self.mins[i], self.maxs[i], self.sums[i] / self.count, self.lasts[i]]
+        return row
+
+    def query(self, t0, t1):
+        columns = self.closed.columns()
+        ts = columns["ts"]
+        window = slice(np.searchsorted(ts, t0 - self.bucket_secs, side="right"), np.searchsorted(ts, t1, side="right"))
+        # Copied, the closed buckets are views the next update may overwrite
+        columns = {name: values[window].copy() for name, values in columns.items()}
+        if self.bucket is not None and t0 - self.bucket_secs < self.bucket * self.bucket_secs <= t1:
+            row = [self.bucket * self.bucket_secs] + self._open_bucket_row()
+            columns = {name: np.append(values, value) for (name, values), value in zip(columns.items(), row)}
+        return columns
+
+
+class MultiResolutionRollup:
+
+    def __init__(self, fields, tiers=DEFAULT_ROLLUP_TIERS):
+        self.fields = tuple(fields)
+        self.tiers = [RollupTier(fields, bucket_secs, capacity) for bucket_secs, capacity in sorted(tiers)]
+        self.lock = threading.Lock()
+
+    def update(self, ts, values):
+        with self.lock:
+            for tier in self.tiers:
+                tier.update(ts, values)
+
+    def late_samples(self):
+        # bucket_secs -> samples each tier dropped for arriving after their bucket closed
+        with self.lock:
+            return {tier.bucket_secs: tier.late for tier in self.tiers}
+
+    def tier_for_window(self, window_secs, max_points):
+        # Finest tier that covers the window without exceeding max_points buckets, else the coarsest
+        for tier in self.tiers:
+            if window_secs / tier.bucket_secs <= max_points and tier.retention_secs >= window_secs:
+                return tier
+        return self.tiers[-1]
+
+    def query(self, t0, t1, max_points):
+        with self.lock:
+            tier = self.tier_for_window(t1 - t0, max_points)
+            return tier.bucket_secs, tier.query(t0, t1)
@@ -0,0 +1,107 @@
+import json
+import operator
+
+from SenseHatCode import sensor_payload_codec
+
+try:
+    # Noticeably faster on the JSON ingest path, used when installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+FLOAT = "float"
+INT = "int"
+FIELD_TYPES = {FLOAT: float, INT: int}
+
+
+class Field:
+
+    def __init__(self, name, type=FLOAT, precision=None):
+        # precision is the number of decimals shown, None for the reader's default
+        self.name = name
+        self.type = type
+        self.precision = precision
+
+
+class TopicSchema:
+    """Layout of one sensor topic and the decoder generated from it.
+
+    decode(payload) turns a JSON or binary payload, single sample or frame,
+    into [(ts, values)] with values in field order, ready for
+    ColumnarRingBuffer.append. Field extraction is a single itemgetter call
+    per sample and values are stored at full precision; precision is only
+    applied when the dashboards render.
+    """
+
+    def __init__(self, stream, fields, binary_sensor=None, rollup_fields=()):
+        self.stream = stream
+        self.fields = tuple(fields)
+        self.field_names = tuple(f.name for f in self.fields)
+        self.precision = {f.name: f.precision for f in self.fields}
+        self.rollup_fields = tuple(rollup_fields)
+        self.rollup_indices = tuple(self.field_names.index(f) for f in self.rollup_fields)
+        self.binary_sensor = binary_sensor
+        self.decode = self.build_decoder()
+
+    def build_decoder(self):
+        names = self.field_names
+        get_values = operator.itemgetter(*names) if len(names) > 1 else lambda s: (s[names[0]],)
+        conversions = [(i, FIELD_TYPES[f.type]) for i, f in enumerate(self.fields) if f.type != FLOAT]
+        if conversions:
+            plain_get_values = get_values
+
+            def get_values(sample):
+                values = list(plain_get_values(sample))
+                for i, convert in conversions:
+                    values[i] = convert(values[i])
+                return values
+
+        binary_order = None
+        if self.binary_sensor is not None:
+            binary_fields = sensor_payload_codec.SENSOR_SCHEMAS[sensor_payload_codec.SENSOR_IDS[self.binary_sensor]][1]
+            binary_order = [binary_fields.index(name) + 1 for name in names]
+        binary_in_order = binary_order == list(range(1, len(names) + 1))
+        binary_sensor = self.binary_sensor
+        stream = self.stream
+
+        def decode(payload):
+            if sensor_payload_codec.is_binary(payload):
+                sensor, records = sensor_payload_codec.decode_records(payload)
+                if sensor != binary_sensor:
+                    raise ValueError("Binary %s payload on the %s topic" % (sensor, stream))
+                if binary_in_order:
+                    return [(r[0], r[1:]) for r in records]
+                return [(r[0], [r[i] for i in binary_order]) for r in records]
+            decoded = json_loads(payload)
+            # Batched frames carry several samples, each with its own "ts"
+            samples = decoded["samples"] if "samples" in decoded else (decoded,)
+            return [(s["ts"], get_values(s)) for s in samples]
+
+        return decode
+
+
+ANGLE_PRECISION = 3
+
+SCHEMAS = {schema.stream: schema for schema in (
+    TopicSchema("basic", (Field("humidity", precision=2),
+                          Field("temperature_c", precision=2),
+                          Field("temperature_from_pressure", precision=2),
+                          Field("pressure_millibars", precision=3),
+                          Field("compass_north", precision=1)),
+                binary_sensor="basic_sensor",
+                rollup_fields=("temperature_c", "humidity", "pressure_millibars")),
+    TopicSchema("accel", (Field("roll", precision=ANGLE_PRECISION),
+                          Field("pitch", precision=ANGLE_PRECISION),
+                          Field("yaw", precision=ANGLE_PRECISION)),
+                binary_sensor="accel"),
+    TopicSchema("gyro", (Field("roll", precision=ANGLE_PRECISION),
+                         Field("pitch", precision=ANGLE_PRECISION),
+                         Field("yaw", precision=ANGLE_PRECISION)),
+                binary_sensor="gyro"),
+    TopicSchema("orientation", (Field("roll", precision=ANGLE_PRECISION),
+                                Field("pitch", precision=ANGLE_PRECISION),
+                                Field("yaw", precision=ANGLE_PRECISION)),
+                binary_sensor="orientation",
+                rollup_fields=("roll", "pitch", "yaw")),
+)}
@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import sensor_capture
+from sensor_data_mqtt_reader import SensorDataReader, DEFAULT_MQTT_SERVER, DEFAULT_QUEUE_LEN
+from sensor_ring_buffer import ColumnarRingBuffer
+
+# The dashboards attach to the ingest process sharing this name instead of reading MQTT themselves
+SHARED_MEMORY_ENV = "SENSE_HAT_SHARED_MEMORY"
+DEFAULT_NAME = "sense_hat"
+DIRECTORY_BYTES = 64 * 1024
+# Attached readers have no condition variable to sleep on, they poll the buffer instead, backing off
+# from WAIT_POLL_SECS to WAIT_POLL_MAX_SECS while nothing changes so idle push clients stay cheap
+WAIT_POLL_SECS = 0.01
+WAIT_POLL_MAX_SECS = 0.25
+
+# int64 header words of a ring buffer segment, the float64 columns follow
+CAPACITY, NO_OF_COLUMNS, COUNT, WRITE_STARTED = range(4)
+BUFFER_HEADER_WORDS = 4
+# int64 header words of the directory segment, JSON device ids follow
+VERSION, LENGTH, QUEUE_LEN = range(3)
+DIRECTORY_HEADER_WORDS = 3
+
+
+def open_segment(name, create=False, size=0):
+    if create:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    segment = shared_memory.SharedMemory(name=name)
+    # Before Python 3.13 attaching registers the segment too, and the tracker would unlink it when we exit
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class SharedRingBuffer(ColumnarRingBuffer):
+    """ColumnarRingBuffer whose columns and counters live in a named shared memory segment.
+
+    The ingest process creates it and is the only writer, any number of
+    processes attach to it and read it zero-copy through since(), or
+    consistently through consistent_since() and snapshot(). count and
+    write_started are kept in the segment so the seqlock read path works
+    across processes.
+    """
+
+    def __init__(self, fields, capacity, name, create=False):
+        self.fields = tuple(fields)
+        self.name = name
+        no_of_columns = len(self.fields) + 1
+        size = (BUFFER_HEADER_WORDS + no_of_columns * 2 * capacity) * 8
+        self.segment = open_segment(name, create, size)
+        self.header = np.ndarray((BUFFER_HEADER_WORDS,), dtype=np.int64, buffer=self.segment.buf)
+        if create:
+            self.header[:] = (capacity, no_of_columns, 0, 0)
+        elif self.header[NO_OF_COLUMNS] != no_of_columns:
+            raise ValueError("Shared buffer %s holds %d columns, expected %d"
+                             % (name, self.header[NO_OF_COLUMNS], no_of_columns))
+        self.capacity = int(self.header[CAPACITY])
+        data = np.ndarray((no_of_columns, 2 * self.capacity), dtype=np.float64, buffer=self.segment.buf,
+                          offset=BUFFER_HEADER_WORDS * 8)
+        self.columns_data = dict(zip(("ts",) + self.fields, data))
+        self._snapshot = None
+        self.write_lock = threading.Lock()
+
+    @property
+    def count(self):
+        return int(self.header[COUNT])
+
+    @count.setter
+    def count(self, value):
+        self.header[COUNT] = value
+
+    @property
+    def write_started(self):
+        return int(self.header[WRITE_STARTED])
+
+    @write_started.setter
+    def write_started(self, value):
+        self.header[WRITE_STARTED] = value
+
+    def close(self):
+        # NumPy views must go before the segment can be closed
+        self.header = self.columns_data = self._snapshot = None
+        self.segment.close()
+
+
+class SharedSensorMemory:
+    """Every device's ring buffers under one name, plus a directory of the device ids.
+
+    Buffer segments are named <name>_<device index>_<stream>, so device ids
+    never have to be valid segment names. The directory is rewritten by the
+    ingest process when a device first appears and read by attached
+    processes under a version counter, odd while a rewrite is in progress.
+    """
+
+    def __init__(self, name=DEFAULT_NAME, queue_len=DEFAULT_QUEUE_LEN, create=False):
+        self.name = name
+        self.create = create
+        self.directory_segment = open_segment(name + "_devices", create, DIRECTORY_BYTES)
+        self.directory_header = np.ndarray((DIRECTORY_HEADER_WORDS,), dtype=np.int64,
+                                           buffer=self.directory_segment.buf)
+        if create:
+            self.directory_header[:] = (0, 0, queue_len)
+        self.queue_len = int(self.directory_header[QUEUE_LEN])
+        self.device_index = {}
+        # (directory version, device ids) last read, parsed again only when the version moves
+        self.directory_cache = (None, [])
+        self.buffers = []
+        self.lock = threading.Lock()
+
+    def device_ids(self):
+        # The returned list is shared, callers must not change it
+        start = DIRECTORY_HEADER_WORDS * 8
+        while True:
+            version = int(self.directory_header[VERSION])
+            cached_version, device_ids = self.directory_cache
+            if version == cached_version:
+                return device_ids
+            if version % 2 == 0:
+                length = int(self.directory_header[LENGTH])
+                data = bytes(self.directory_segment.buf[start:start + length])
+                if int(self.directory_header[VERSION]) == version:
+                    device_ids = json.loads(data) if length else []
+                    self.directory_cache = (version, device_ids)
+                    return device_ids
+            time.sleep(WAIT_POLL_SECS)
+
+    def _index_of(self, device_id):
+        with self.lock:
+            index = self.device_index.get(device_id)
+            if index is None:
+                device_ids = list(self.device_ids())
+                if device_id not in device_ids:
+                    if not self.create:
+                        raise KeyError(device_id)
+                    device_ids.append(device_id)
+                    self._write_directory(device_ids)
+                index = self.device_index[device_id] = device_ids.index(device_id)
+            return index
+
+    def _write_directory(self, device_ids):
+        data = json.dumps(device_ids).encode("utf-8")
+        start = DIRECTORY_HEADER_WORDS * 8
+        if start + len(data) > DIRECTORY_BYTES:
+            raise ValueError("Too many devices for the shared memory directory")
+        self.directory_header[VERSION] += 1
+        self.directory_segment.buf[start:start + len(data)] = data
+        self.directory_header[LENGTH] = len(data)
+        self.directory_header[VERSION] += 1
+
+    def buffer(self, device_id, stream, fields, capacity):
+        # Matches SensorDataReader's buffer_factory, creates or attaches depending on the mode
+        name = "%s_%d_%s" % (self.name, self._index_of(device_id), stream)
+        buffer = SharedRingBuffer(fields, capacity, name, self.create)
+        self.buffers.append(buffer)
+        return buffer
+
+    def close(self):
+        # The creating process also removes the segments, attached processes only let go of them
+        segments = [buffer.segment for buffer in self.buffers] + [self.directory_segment]
+        for buffer in self.buffers:
+            buffer.close()
+        self.directory_header = None
+        self.directory_segment.close()
+        if self.create:
+            for segment in segments:
+                segment.unlink()
+
+
+class SharedSensorDataReader(SensorDataReader):
+    """Attach-only SensorDataReader for dashboard worker processes.
+
+    Reads the buffers an ingest process (run this module) keeps in shared
+    memory, so any number of workers share one MQTT subscription and one
+    decode of every message. Rollups and history stay with the ingest
+    process; this reader cannot store samples or connect to MQTT.
+    """
+
+    keep_rollups = False
+
+    def __init__(self, name=DEFAULT_NAME, **kwargs):
+        try:
+            self.shared_memory = SharedSensorMemory(name)
+        except FileNotFoundError:
+            raise RuntimeError("No sensor ingest process is sharing '%s'" % name) from None
+        super().__init__(queue_len=self.shared_memory.queue_len, buffer_factory=self.shared_memory.buffer, **kwargs)
+
+    def init_ingest(self, queue_len, overflow_policy, workers):
+        # Nothing is decoded here
+        self.ingest = None
+
+    def init_metrics(self):
+        # Ingest counters belong to the ingest process, only the buffers are visible here
+        self.init_buffer_metrics()
+
+    def device(self, device_id):
+        # Devices the ingest process created are attached on first use, others get the empty stand-in
+        if device_id not in self.devices and device_id in self.shared_memory.device_ids():
+            return self.add_device(device_id)
+        return super().device(device_id)
+
+    def has_device(self, device_id):
+        return device_id in self.devices or device_id in self.shared_memory.device_ids()
+
+    def device_ids(self):
+        return sorted(self.shared_memory.device_ids())
+
+    def wait_for_data(self, predicate, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poll_secs = WAIT_POLL_SECS
+        while not predicate():
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return predicate()
+            time.sleep(poll_secs if deadline is None else min(poll_secs, deadline - now))
+            poll_secs = min(poll_secs * 2, WAIT_POLL_MAX_SECS)
+        return True
+
+    def open_history(self, history_dir, retention_secs=None):
+        raise RuntimeError("SharedSensorDataReader is read only, history is kept by the ingest process")
+
+    def query_rollup(self, stream, t0, t1, max_points, device_id=None):
+        raise RuntimeError("SharedSensorDataReader has no rollups, they are kept by the ingest process")
+
+    def close(self):
+        super().close()
+        self.shared_memory.close()
+
+    def store_sample(self, stream, ts, values, device=None):
+        raise RuntimeError("SharedSensorDataReader is read only, samples are stored by the ingest process")
+
+    def init_and_start_mqtt(self, client=None):
+        raise RuntimeError("SharedSensorDataReader is read only, the ingest process reads MQTT")
+
+
+def reader_from_environment(**kwargs):
+    # Attached reader when SHARED_MEMORY_ENV names an ingest process, else a SensorDataReader of our own
+    name = os.environ.get(SHARED_MEMORY_ENV)
+    if name:
+        return SharedSensorDataReader(name)
+    return SensorDataReader(**kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Read Sense Hat data from MQTT into shared memory for dashboard workers started with "
+                    + SHARED_MEMORY_ENV + "=<name>")
+    parser.add_argument("--name", default=DEFAULT_NAME)
+    parser.add_argument("--mq_server", default=DEFAULT_MQTT_SERVER)
+    parser.add_argument("--queue_len", type=int, default=DEFAULT_QUEUE_LEN)
+    parser.add_argument("--ingest_workers", type=int, default=1)
+    parser.add_argument("--history_dir", default=None)
+    sensor_capture.add_arguments(parser)
+    args = parser.parse_args()
+
+    memory = SharedSensorMemory(args.name, args.queue_len, create=True)
+    reader = SensorDataReader(mq_server=args.mq_server, queue_len=args.queue_len,
+                              ingest_workers=args.ingest_workers, history_dir=args.history_dir,
+                              buffer_factory=memory.buffer)
+    try:
+        sensor_capture.start_reader(reader, args)
+        print("Sharing sensor data as '%s'" % args.name)
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+        memory.close()
@@ -0,0 +1,197 @@
+import argparse
+import math
+import time
+import threading
+from collections import deque
+
+from sensor_schema_registry import SCHEMAS
+
+NEAREST = "nearest"
+AS_OF = "as_of"
+JOIN_MODES = (NEAREST, AS_OF)
+
+DEFAULT_JOIN_STREAMS = ("accel", "gyro", "orientation")
+DEFAULT_JOIN_NAME = "imu"
+DEFAULT_TOLERANCE_SECS = 0.05
+# How far the leading stream may run ahead of a silent stream before rows go out without it
+DEFAULT_MAX_DELAY_SECS = 1.0
+
+
+class JoinState:
+    # Per device: leading samples waiting to be joined and recent samples of every other stream
+
+    def __init__(self, followers):
+        self.pending = deque()
+        # ts of the last leading sample joined, no later one can need follower samples much older than this
+        self.leader_ts = None
+        self.followers = {stream: deque() for stream in followers}
+
+
+class StreamJoin:
+    """Streaming merge-join of several sensor streams on their timestamps.
+
+    The first stream leads: every one of its samples becomes one combined
+    row, <stream>_<field> columns, holding the other streams' values at that
+    ts. AS_OF takes the latest sample at or before ts, NEAREST the closest on
+    either side; either way only within tolerance_secs, NaN otherwise. With
+    interpolate the values are linear between the samples either side of ts
+    when both are within tolerance.
+
+    A leading sample is joined once every other stream has reached its ts,
+    or once the leading stream is max_delay_secs further on, so rows come out
+    in order and late streams do not hold everything up. Delays are measured
+    in sample time, which only works while one device's streams are stored
+    in the order they arrived: SensorDataReader keeps them on one ingest
+    worker when it has a join. Each sample is
+    queued and dropped once, the join is linear in the number of samples.
+    Samples older than the last one of their stream are dropped and counted.
+    Other streams only keep what a future leading sample can still match,
+    so they stay bounded even while the leading stream is silent.
+    """
+
+    def __init__(self, streams=DEFAULT_JOIN_STREAMS, name=DEFAULT_JOIN_NAME, tolerance_secs=DEFAULT_TOLERANCE_SECS,
+                 mode=NEAREST, interpolate=False, max_delay_secs=DEFAULT_MAX_DELAY_SECS, schemas=SCHEMAS):
+        if mode not in JOIN_MODES:
+            raise ValueError("Unknown join mode " + str(mode))
+        if len(streams) < 2:
+            raise ValueError("A join needs at least two streams")
+        self.streams = tuple(streams)
+        self.leader = self.streams[0]
+        self.followers = self.streams[1:]
+        self.name = name
+        self.tolerance_secs = tolerance_secs
+        self.mode = mode
+        self.interpolate = interpolate
+        self.max_delay_secs = max_delay_secs
+        self.fields = tuple("%s_%s" % (stream, field) for stream in self.streams
+                            for field in schemas[stream].field_names)
+        self.missing = {stream: (math.nan,) * len(schemas[stream].field_names) for stream in self.followers}
+        self.states = {}
+        self.lock = threading.Lock()
+        self.joined = 0
+        self.out_of_order = 0
+
+    def process(self, device_id, stream, ts, values):
+        """Adds one sample, returns the [(ts, values)] rows it completed, values in fields order."""
+        if stream not in self.streams:
+            return []
+        with self.lock:
+            state = self.states.get(device_id)
+            if state is None:
+                state = self.states[device_id] = JoinState(self.followers)
+            if stream == self.leader:
+                samples = state.pending
+                # pending is empty after every drain, the last joined ts still orders the stream
+                last_ts = samples[-1][0] if samples else state.leader_ts
+            else:
+                samples = state.followers[stream]
+                last_ts = samples[-1][0] if samples else None
+            if last_ts is not None and ts < last_ts:
+                self.out_of_order += 1
+                return []
+            samples.append((ts, tuple(values)))
+            if stream != self.leader:
+                self._trim(state, samples, ts)
+            return self._drain(state)
+
+    def _trim(self, state, samples, ts):
+        # Leading samples further behind this stream than max_delay_secs go out without waiting for it
+        horizon = ts - self.max_delay_secs
+        leader_ts = state.pending[0][0] if state.pending else state.leader_ts
+        if leader_ts is not None:
+            horizon = max(horizon, leader_ts)
+        horizon -= self.tolerance_secs
+        while len(samples) > 1 and samples[1][0] <= horizon:
+            samples.popleft()
+
+    def _drain(self, state):
+        rows = []
+        pending = state.pending
+        while pending:
+            ts, values = pending[0]
+            if pending[-1][0] - ts <= self.max_delay_secs and not all(
+                    samples and samples[-1][0] >= ts for samples in state.followers.values()):
+                break
+            pending.popleft()
+            state.leader_ts = ts
+            row = list(values)
+            for stream, samples in state.followers.items():
+                row.extend(self._align(samples, ts, self.missing[stream]))
+            rows.append((ts, row))
+        self.joined += len(rows)
+        return rows
+
+    def _align(self, samples, ts, missing):
+        # Leading timestamps only grow, so samples before the last one at or before ts are never needed again
+        while len(samples) > 1 and samples[1][0] <= ts:
+            samples.popleft()
+        before = after = None
+        if samples and samples[0][0] <= ts:
+            before = samples[0]
+            if len(samples) > 1:
+                after = samples[1]
+        elif samples:
+            after = samples[0]
+        tolerance = self.tolerance_secs
+        before = before if before is not None and ts - before[0] <= tolerance else None
+        after = after if after is not None and after[0] - ts <= tolerance else None
+        if before is not None and before[0] == ts:
+            return before[1]
+        if self.interpolate and before is not None and after is not None:
+            weight = (ts - before[0]) / (after[0] - before[0])
+            return [b + (a - b) * weight for b, a in zip(before[1], after[1])]
+        if self.mode == AS_OF or after is None:
+            return missing if before is None else before[1]
+        if before is None or after[0] - ts < ts - before[0]:
+            return after[1]
+        return before[1]
+
+
+def add_arguments(parser):
+    # --join options shared by the ingest entry points
+    parser.add_argument("--join", nargs="+", default=None, metavar="STREAM",
+                        help="Join these streams on their timestamps into one stream, the first one leads, "
+                             "e.g. " + " ".join(DEFAULT_JOIN_STREAMS))
+    parser.add_argument("--join_name", default=DEFAULT_JOIN_NAME)
+    parser.add_argument("--join_mode", choices=JOIN_MODES, default=NEAREST)
+    parser.add_argument("--join_tolerance_secs", type=float, default=DEFAULT_TOLERANCE_SECS)
+    parser.add_argument("--join_max_delay_secs", type=float, default=DEFAULT_MAX_DELAY_SECS)
+    parser.add_argument("--join_interpolate", action="store_true")
+
+
+def from_arguments(args):
+    # StreamJoin for the add_arguments options, None without --join
+    if not args.join:
+        return None
+    return StreamJoin(args.join, args.join_name, args.join_tolerance_secs, args.join_mode, args.join_interpolate,
+                      args.join_max_delay_secs)
+
+
+if __name__ == '__main__':
+    # Joined rows without a dashboard: prints the latest row of every device once a second
+    import sensor_capture
+    from sensor_data_mqtt_reader import SensorDataReader, DEFAULT_MQTT_SERVER
+
+    parser = argparse.ArgumentParser(description="Join Sense Hat streams on their timestamps")
+    parser.add_argument("--mq_server", default=DEFAULT_MQTT_SERVER)
+    parser.add_argument("--ingest_workers", type=int, default=1)
+    add_arguments(parser)
+    sensor_capture.add_arguments(parser)
+    parser.set_defaults(join=list(DEFAULT_JOIN_STREAMS))
+    args = parser.parse_args()
+
+    join = from_arguments(args)
+    reader = SensorDataReader(mq_server=args.mq_server, ingest_workers=args.ingest_workers, join=join)
+    sensor_capture.start_reader(reader, args)
+    try:
+        while True:
+            time.sleep(1)
+            for device_id in reader.device_ids():
+                latest = reader.snapshot(join.name, device_id).latest()
+                if latest is not None:
+                    print(device_id, latest)
+            print("Joined %d rows, %d samples out of order" % (join.joined, join.out_of_order))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()